@@ -0,0 +1,252 @@
+import asyncio
+from contextlib import asynccontextmanager
+import json
+from .data_pull import client_session, fetch
+from .pagination import dig
+from .scheduler import AdaptiveScheduler
+
+
+def payload_size(payload):
+    """
+    Bytes a payload adds to a JSON request body
+
+    Parameters
+    ----------
+    payload : obj
+    Returns
+    -------
+    size : int
+    """
+    return len(json.dumps(payload, separators=(',', ':'),
+                          default=str).encode('utf-8'))
+
+
+class PostBatching:
+    """
+    How to pack post payloads into batched requests for endpoints that
+    accept an array of queries and answer with an array of results in the
+    same order
+
+    Parameters
+    ----------
+    batch_size : int
+      most payloads per request
+    batch_bytes : int, optional
+      most serialized payload bytes per request, a payload bigger than
+      this is sent on its own
+    body_key : str, optional
+      send {body_key: [payloads]} instead of a bare array
+    results_key : str, optional
+      dotted path to the results array in the response, the response
+      itself if None
+    """
+
+    def __init__(self, batch_size=100, batch_bytes=None, body_key=None,
+                 results_key=None):
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.body_key = body_key
+        self.results_key = results_key
+
+    def pack(self, payloads):
+        """
+        Groups payloads into batches
+
+        Parameters
+        ----------
+        payloads : [obj]
+        Returns
+        -------
+        batches : [[int]]
+          indexes into payloads, in order
+        """
+        batches = []
+        batch, size = [], 0
+        for i, payload in enumerate(payloads):
+            n = payload_size(payload) if self.batch_bytes else 0
+            if batch and (len(batch) >= self.batch_size or (
+                    self.batch_bytes and size + n > self.batch_bytes)):
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(i)
+            size += n
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def body(self, payloads):
+        return {self.body_key: payloads} if self.body_key else payloads
+
+    def split(self, response, count, missing=None):
+        """
+        Per-payload results from a batched response
+
+        Parameters
+        ----------
+        response : obj
+          decoded response, None when the request failed
+        count : int
+          payloads in the batch
+        missing : obj, optional
+          result given to every payload when the response doesn't hold
+          count results
+        Returns
+        -------
+        results : list
+          count results, all `missing` when the request failed or the
+          response doesn't hold count results
+        """
+        results = dig(response, self.results_key) \
+            if self.results_key and response is not None else response
+        if not isinstance(results, list) or len(results) != count:
+            if response is not None:
+                print(f"\nBatched response held {results!r:.80} "
+                      f"instead of {count} results")
+            return [missing] * count
+        return results
+
+
+class MicroBatcher:
+    """
+    Collects payloads submitted over time into batched requests, sending
+    a batch when it is full or `linger` seconds after its first payload
+
+    Parameters
+    ----------
+    send : callable
+      coroutine function taking a request body and returning the decoded
+      response
+    batching : PostBatching
+      batch size limits and request/response shape
+    linger : float
+      seconds to wait for a batch to fill before sending it anyway
+    """
+
+    def __init__(self, send, batching=None, linger=0.01):
+        self.send = send
+        self.batching = batching or PostBatching()
+        self.linger = linger
+        self._payloads = []
+        self._futures = []
+        self._bytes = 0
+        self._timer = None
+        self._tasks = set()
+
+    def submit(self, payload):
+        """
+        Queues a payload
+
+        Parameters
+        ----------
+        payload : obj
+        Returns
+        -------
+        result : asyncio.Future
+          resolves to this payload's result
+        """
+        batching = self.batching
+        n = payload_size(payload) if batching.batch_bytes else 0
+        if self._payloads and batching.batch_bytes \
+                and self._bytes + n > batching.batch_bytes:
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self._payloads.append(payload)
+        self._futures.append(future)
+        self._bytes += n
+        if len(self._payloads) >= batching.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.linger, self.flush)
+        return future
+
+    def flush(self):
+        """
+        Sends whatever is queued now
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._payloads:
+            return
+        payloads, futures = self._payloads, self._futures
+        self._payloads, self._futures, self._bytes = [], [], 0
+        task = asyncio.ensure_future(self._send(payloads, futures))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, payloads, futures):
+        try:
+            response = await self.send(self.batching.body(payloads))
+            results = self.batching.split(response, len(payloads))
+        except Exception as error:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """
+        Sends what is queued and waits for every batch in flight
+        """
+        self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+
+@asynccontextmanager
+async def micro_batcher(self, url, cert, batching=None, linger=0.01,
+                        scheduler=None, **fetch_kwargs):
+    """
+    MicroBatcher posting batches to url through data_pull.fetch
+
+    Parameters
+    ----------
+    url : str
+      bulk endpoint accepting an array of payloads
+    cert : str
+      filepath for certificate
+    batching : PostBatching, optional
+      batch size limits and request/response shape
+    linger : float
+      seconds to wait for a batch to fill before sending it anyway
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    **fetch_kwargs
+      passed to fetch, e.g. retry_policy, rate_limiter, timer
+    Returns
+    -------
+    batcher : MicroBatcher
+    """
+    if scheduler is None:
+        scheduler = AdaptiveScheduler()
+    async with client_session(self, cert, scheduler) as session:
+
+        async def send(body):
+            return await fetch(self, url, session, post=True, post_json=body,
+                               scheduler=scheduler, **fetch_kwargs)
+
+        batcher = MicroBatcher(send, batching, linger)
+        try:
+            yield batcher
+        finally:
+            await batcher.close()
+
+
+"""
+How to use:
+from toolbox.batching import PostBatching, micro_batcher
+# 10,000 queries sent as 20 requests of 500
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, [bulk_url], cert_path, post=True, post_jsons=queries,
+    batching=PostBatching(batch_size=500, batch_bytes=2**20,
+                          body_key='queries', results_key='results'))
+
+# payloads produced over time
+async with micro_batcher(session_module, bulk_url, cert_path,
+                         PostBatching(batch_size=200), linger=0.02) as batcher:
+    results = await asyncio.gather(*[batcher.submit(q) async for q in queries])
+"""
@@ -0,0 +1,614 @@
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+from . import data_pull
+from .retry_policy import RetryPolicy
+from .runner import run_sync
+from .scheduler import AdaptiveScheduler
+from .timing import Histogram, RequestTimer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# HTTP/2 stub server, the aiohttp one only speaks HTTP/1.1
+try:
+    import hypercorn
+except ImportError:
+    hypercorn = None
+
+MODES = ('sync', 'threads', 'async_requests', 'aiohttp', 'http2')
+SERVERS = {'aiohttp': 'aiohttp, HTTP/1.1',
+           'hypercorn': 'hypercorn, HTTP/2 and HTTP/1.1 by ALPN'}
+# metric path, True when a higher value is better
+METRICS = (
+    (('rps',), True),
+    (('latency_ms', 'p50'), False),
+    (('latency_ms', 'p95'), False),
+    (('latency_ms', 'p99'), False),
+    (('cpu_ms_per_request',), False),
+    (('peak_rss_mb',), False),
+)
+
+
+def make_certificates(directory, password='benchmark'):
+    """
+    Writes a throwaway CA, a server certificate for localhost and a client
+    certificate in a password protected PKCS#12 file
+
+    Parameters
+    ----------
+    directory : str
+      folder to write the files to
+    password : str
+      password of the PKCS#12 file
+    Returns
+    -------
+    paths : dict
+      'ca', 'server_cert', 'server_key' and 'client' file paths
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def name(common_name):
+        return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME,
+                                             common_name)])
+
+    def builder(subject, issuer, key):
+        return (x509.CertificateBuilder()
+                .subject_name(name(subject)).issuer_name(name(issuer))
+                .public_key(key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - datetime.timedelta(days=1))
+                .not_valid_after(now + datetime.timedelta(days=7)))
+
+    ca_key = ec.generate_private_key(ec.SECP256R1())
+    ca = builder('toolbox benchmark CA', 'toolbox benchmark CA', ca_key) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                       critical=True) \
+        .sign(ca_key, hashes.SHA256())
+    server_key = ec.generate_private_key(ec.SECP256R1())
+    server = builder('localhost', 'toolbox benchmark CA', server_key) \
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.DNSName('localhost')]), critical=False) \
+        .sign(ca_key, hashes.SHA256())
+    client_key = ec.generate_private_key(ec.SECP256R1())
+    client = builder('toolbox benchmark client', 'toolbox benchmark CA',
+                     client_key).sign(ca_key, hashes.SHA256())
+
+    paths = {name: os.path.join(directory, file) for name, file in (
+        ('ca', 'ca.pem'), ('server_cert', 'server.pem'),
+        ('server_key', 'server.key'), ('client', 'client.p12'))}
+    pem = serialization.Encoding.PEM
+    with open(paths['ca'], 'wb') as file:
+        file.write(ca.public_bytes(pem))
+    with open(paths['server_cert'], 'wb') as file:
+        file.write(server.public_bytes(pem))
+    with open(paths['server_key'], 'wb') as file:
+        file.write(server_key.private_bytes(
+            pem, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+    with open(paths['client'], 'wb') as file:
+        file.write(pkcs12.serialize_key_and_certificates(
+            b'client', client_key, client, [ca],
+            serialization.BestAvailableEncryption(password.encode('utf-8'))))
+    return paths
+
+
+def _payload(size):
+    # a JSON array of small records, so decoding costs what real responses
+    # of that size cost
+    count = max(1, size // 80)
+    return json.dumps([
+        {'id': i, 'name': f'item-{i:06d}', 'value': i * 0.5,
+         'tags': ['alpha', 'beta'], 'active': i % 2 == 0}
+        for i in range(count)]).encode('utf-8')
+
+
+def _serve(port, paths, latency, payload_size, error_rate, reuse_port,
+           ready, server='aiohttp'):
+    if server == 'hypercorn':
+        return _serve_hypercorn(port, paths, latency, payload_size,
+                                error_rate, reuse_port, ready)
+    from aiohttp import web
+
+    body = _payload(payload_size)
+
+    async def handler(request):
+        if latency:
+            await asyncio.sleep(latency)
+        if error_rate and random.random() < error_rate:
+            return web.Response(status=503)
+        return web.Response(body=body, content_type='application/json')
+
+    async def main():
+        sslcontext = ssl.create_default_context(
+            ssl.Purpose.CLIENT_AUTH, cafile=paths['ca'])
+        sslcontext.load_cert_chain(paths['server_cert'], paths['server_key'])
+        sslcontext.verify_mode = ssl.CERT_REQUIRED
+        app = web.Application()
+        app.router.add_get('/{tail:.*}', handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, 'localhost', port, ssl_context=sslcontext,
+                          reuse_port=reuse_port, backlog=4096).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def _serve_hypercorn(port, paths, latency, payload_size, error_rate,
+                     reuse_port, ready):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    body = _payload(payload_size)
+    headers = [(b'content-type', b'application/json'),
+               (b'content-length', str(len(body)).encode())]
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if latency:
+            await asyncio.sleep(latency)
+        if error_rate and random.random() < error_rate:
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': [(b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    # bound here so processes can share the port and clients queue in the
+    # backlog until serve() accepts them
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('localhost', port))
+    sock.listen(4096)
+    config = Config()
+    config.bind = [f'fd://{sock.fileno()}']
+    config.certfile = paths['server_cert']
+    config.keyfile = paths['server_key']
+    config.ca_certs = paths['ca']
+    config.verify_mode = ssl.CERT_REQUIRED
+    config.backlog = 4096
+    config.keep_alive_max_requests = 2**31
+    config.h2_max_concurrent_streams = 1000
+    config.accesslog = None
+    ready.set()
+    asyncio.run(serve(app, config))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def stub_server(paths, latency=0.02, payload_size=2048, error_rate=0.0,
+                processes=1, server='aiohttp'):
+    """
+    Local HTTPS server that requires the client certificate, answers every
+    GET after `latency` seconds with a JSON array of about `payload_size`
+    bytes, and fails `error_rate` of them with 503
+
+    Parameters
+    ----------
+    paths : dict
+      files written by make_certificates
+    latency : float
+      seconds each response is delayed
+    payload_size : int
+      bytes in each response body
+    error_rate : float
+      share of responses that are 503
+    processes : int
+      server processes sharing the port, more keep the server from
+      being the bottleneck where SO_REUSEPORT is available
+    server : str
+      'aiohttp' for HTTP/1.1 or 'hypercorn' for HTTP/2, which needs
+      hypercorn installed
+    Returns
+    -------
+    url : str
+      base URL of the server
+    """
+    if server not in SERVERS:
+        raise ValueError(f"server must be one of {tuple(SERVERS)}, "
+                         f"not {server!r}")
+    if server == 'hypercorn' and hypercorn is None:
+        raise ImportError("the HTTP/2 stub server requires hypercorn")
+    port = _free_port()
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    try:
+        for _ in range(processes):
+            ready = context.Event()
+            worker = context.Process(target=_serve, daemon=True, args=(
+                port, paths, latency, payload_size, error_rate,
+                processes > 1, ready, server))
+            worker.start()
+            workers.append(worker)
+            if not ready.wait(30):
+                raise RuntimeError("stub server didn't start")
+        yield f'https://localhost:{port}'
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+class _Credentials:
+    """
+    Stand-in for Session, holds what data_pull.get_client needs
+    """
+
+    def __init__(self, pw, transport):
+        self.pw = pw
+        self.transport = transport
+        self.async_client = None
+
+
+def _peak_rss_mb():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss) / 2**20
+    return None
+
+
+def _requests_session(paths, password, concurrency, record):
+    import requests
+    from requests_pkcs12 import Pkcs12Adapter
+
+    adapter = Pkcs12Adapter(
+        pkcs12_filename=paths['client'], pkcs12_password=password,
+        pool_connections=concurrency, pool_maxsize=concurrency)
+    # the adapter's context verifies servers, not session.verify
+    adapter.ssl_context.load_verify_locations(paths['ca'])
+    session = requests.Session()
+    session.mount('https://', adapter)
+    get = session.get
+    lock = threading.Lock()
+
+    def timed_get(url, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return get(url, **kwargs)
+        finally:
+            with lock:
+                record(time.perf_counter_ns() - start)
+
+    session.get = timed_get
+    return session
+
+
+def _run_mode(mode, url, paths, password, requests, concurrency, warmup,
+              adaptive):
+    # runs in a fresh process so peak RSS and CPU belong to this mode only
+    urls = [f'{url}/item/{i}' for i in range(requests)]
+    warm = [f'{url}/warmup/{i}' for i in range(warmup)]
+    policy = RetryPolicy(
+        retry_on=data_pull.default_retry_policy.retry_on, backoff=0.01,
+        max_backoff=0.1, breaker_threshold=requests + warmup + 1)
+    histogram = Histogram()
+    timer = RequestTimer()
+
+    def record(ns):
+        histogram.add(ns)
+
+    if mode in ('sync', 'threads', 'async_requests'):
+        session = _requests_session(paths, password, concurrency, record)
+        workers = 1 if mode == 'sync' else concurrency
+        if mode == 'async_requests':
+            def pull(urls):
+                return [response.ok for response in
+                        data_pull.async_requests_get_all(
+                            urls, session, workers=workers)]
+        else:
+            def pull(urls):
+                return data_pull.sync_requests_get_all(
+                    urls, session, retry_policy=policy, workers=workers)
+    else:
+        client = _Credentials(password, mode)
+        client.async_client = data_pull.TRANSPORTS[mode](
+            paths['client'], password, cafile=paths['ca'])
+
+        def pull(urls):
+            scheduler = AdaptiveScheduler(concurrency) if adaptive \
+                else AdaptiveScheduler(concurrency,
+                                       initial_concurrency=concurrency,
+                                       min_concurrency=concurrency)
+            return data_pull.async_aiohttp_get_all(
+                client, urls, paths['client'], get=True,
+                scheduler=scheduler, retry_policy=policy, timer=timer)[0]
+
+    if warm:
+        pull(warm)
+        histogram = Histogram()
+        timer = RequestTimer()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    results = pull(urls)
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    if mode in data_pull.TRANSPORTS:
+        run_sync(client.async_client.close())
+
+    if mode in data_pull.TRANSPORTS:
+        latency = timer.summary()['hosts'].get(
+            urlsplit(url).netloc, {}).get('total')
+    else:
+        latency = histogram.summary() if histogram.count else None
+    return {
+        'requests': requests,
+        'ok': sum(1 for result in results if result),
+        'seconds': seconds,
+        'rps': requests / seconds,
+        'latency_ms': latency,
+        'cpu_seconds': cpu,
+        'cpu_percent': 100 * cpu / seconds,
+        'cpu_ms_per_request': 1000 * cpu / requests,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def _in_process(*args):
+    with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        try:
+            return pool.submit(*args).result()
+        except Exception as error:
+            return {'error': repr(error)}
+
+
+def run(modes=MODES, requests=2000, concurrency=100, latency=0.02,
+        payload_size=2048, error_rate=0.0, warmup=0, adaptive=False,
+        server_processes=1, output=None, server='aiohttp'):
+    """
+    Benchmarks data_pull's request modes against a local stub server with
+    mutual TLS
+
+    Every mode runs in a fresh process against the same server, so its
+    CPU time and peak RSS are its own and connections start cold unless
+    `warmup` requests are made first. The aiohttp stub only speaks
+    HTTP/1.1, so with it the http2 mode runs against a hypercorn stub of
+    its own and is skipped when hypercorn isn't installed. To compare the
+    transports on one server use server='hypercorn'.
+
+    Parameters
+    ----------
+    modes : [str]
+      any of 'sync' (sync_requests_get_all), 'threads'
+      (sync_requests_get_all with `concurrency` workers),
+      'async_requests' (async_requests_get_all), 'aiohttp' and 'http2'
+      (async_aiohttp_get_all through that transport)
+    requests : int
+      timed requests per mode, all to distinct URLs
+    concurrency : int
+      requests in flight, threads for the requests based modes
+    latency : float
+      seconds the server delays each response
+    payload_size : int
+      bytes in each response body
+    error_rate : float
+      share of responses that are 503, retried with a short backoff
+    warmup : int
+      untimed requests made first on the same connections
+    adaptive : bool
+      let AdaptiveScheduler find the concurrency instead of holding it
+      at `concurrency`
+    server_processes : int
+      stub server processes
+    output : str, optional
+      file the results are written to as JSON
+    server : str
+      stub server, 'aiohttp' (HTTP/1.1) or 'hypercorn' (HTTP/2, needs
+      hypercorn)
+    Returns
+    -------
+    results : dict
+      'meta' with the parameters, platform and the server each mode ran
+      against, and per mode requests, ok, seconds, rps, latency_ms (count
+      and mean/p50/p95/p99/max per try), cpu_seconds, cpu_percent,
+      cpu_ms_per_request and peak_rss_mb, 'error' if the mode couldn't
+      run or 'skipped' if it had no server to run against
+    """
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        raise ValueError(f"unknown modes {sorted(unknown)}, "
+                         f"choose from {MODES}")
+    params = dict(requests=requests, concurrency=concurrency,
+                  latency=latency, payload_size=payload_size,
+                  error_rate=error_rate, warmup=warmup, adaptive=adaptive,
+                  server_processes=server_processes, server=server)
+    # http2 against an HTTP/1.1-only server would measure HTTP/1.1
+    servers = {mode: 'hypercorn' if mode == 'http2' else server
+               for mode in modes}
+    results = {'meta': {
+        'created': datetime.datetime.now(
+            datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'server': {mode: SERVERS[servers[mode]] for mode in modes},
+        'params': params,
+    }, 'modes': {}}
+    password = 'benchmark'
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_certificates(directory, password)
+        for name in SERVERS:
+            batch = [mode for mode in modes if servers[mode] == name]
+            if not batch:
+                continue
+            if name == 'hypercorn' and hypercorn is None:
+                for mode in batch:
+                    results['modes'][mode] = {
+                        'skipped': "needs hypercorn for an HTTP/2 server"}
+                continue
+            with stub_server(paths, latency, payload_size, error_rate,
+                             server_processes, name) as url:
+                for mode in batch:
+                    results['modes'][mode] = _in_process(
+                        _run_mode, mode, url, paths, password, requests,
+                        concurrency, warmup, adaptive)
+    # in the order asked for
+    results['modes'] = {mode: results['modes'][mode] for mode in modes}
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def compare(baseline, results, tolerance=0.1):
+    """
+    Regressions of results against an earlier run
+
+    Parameters
+    ----------
+    baseline : dict
+      results of run(), or the JSON it wrote, from the earlier version
+    results : dict
+      results of run() from this version
+    tolerance : float
+      relative change treated as noise
+    Returns
+    -------
+    regressions : [str]
+      one line per metric of a mode that got worse by more than
+      tolerance
+    """
+    regressions = []
+    if baseline['meta']['params'] != results['meta']['params']:
+        regressions.append("parameters differ, results aren't comparable")
+    for mode, current in results['modes'].items():
+        before = baseline['modes'].get(mode)
+        if not before or 'rps' not in before or 'rps' not in current:
+            continue
+        for path, higher_is_better in METRICS:
+            old, new = before, current
+            for key in path:
+                old = (old or {}).get(key)
+                new = (new or {}).get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{mode} {'.'.join(path)}: {old:.4g} -> {new:.4g} "
+                    f"({change:+.0%})")
+    return regressions
+
+
+def _table(results):
+    lines = [f"{'mode':<15}{'ok':>7}{'req/s':>9}{'p50 ms':>9}"
+             f"{'p95 ms':>9}{'p99 ms':>9}{'cpu %':>8}{'rss MB':>8}"]
+    for mode, result in results['modes'].items():
+        if 'rps' not in result:
+            lines.append(f"{mode:<15}"
+                         f"{result.get('error') or result.get('skipped')}")
+            continue
+        latency = result['latency_ms'] or {}
+        lines.append(
+            f"{mode:<15}{result['ok']:>7}{result['rps']:>9.0f}"
+            f"{latency.get('p50') or 0:>9.1f}{latency.get('p95') or 0:>9.1f}"
+            f"{latency.get('p99') or 0:>9.1f}{result['cpu_percent']:>8.0f}"
+            f"{result['peak_rss_mb'] or 0:>8.0f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark data_pull request modes against a local "
+                    "HTTPS stub server")
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=MODES)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds the server delays each response")
+    parser.add_argument('--payload-size', type=int, default=2048,
+                        help="bytes in each response body")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="share of responses that are 503")
+    parser.add_argument('--warmup', type=int, default=0)
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--server-processes', type=int, default=1)
+    parser.add_argument('--server', default='aiohttp', choices=SERVERS,
+                        help="stub server, hypercorn speaks HTTP/2; the "
+                             "http2 mode always uses hypercorn")
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--baseline',
+                        help="JSON of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    results = run(args.modes, args.requests, args.concurrency, args.latency,
+                  args.payload_size, args.error_rate, args.warmup,
+                  args.adaptive, args.server_processes, args.output,
+                  args.server)
+    print(_table(results))
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+"""
+How to use:
+python -m toolbox.benchmark --requests 5000 --concurrency 200 \\
+    --latency 0.03 --payload-size 4096 --output bench.json
+python -m toolbox.benchmark --requests 5000 --concurrency 200 \\
+    --latency 0.03 --payload-size 4096 --baseline bench.json
+
+# both transports against the same HTTP/2 server
+python -m toolbox.benchmark --server hypercorn --modes aiohttp http2 \\
+    --requests 2000 --concurrency 200 --latency 0.05
+
+from toolbox.benchmark import run, compare
+results = run(modes=['threads', 'aiohttp'], requests=2000, concurrency=100)
+results['modes']['aiohttp']['rps']
+"""
@@ -0,0 +1,237 @@
+from collections.abc import Sequence
+from itertools import islice
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class Checkpoint:
+    """
+    SQLite journal of completed requests and their decoded results, so an
+    interrupted bulk pull resumes where it stopped
+
+    Results are written as they arrive and committed every `commit_every`
+    records or `commit_seconds`, whichever comes first, so a dead kernel
+    loses at most one commit's worth of work. Failed requests are not
+    journaled and are retried on the next run, a JSON null result is.
+
+    Parameters
+    ----------
+    path : str
+      journal database file, created if missing
+    commit_every : int
+      most results written between commits
+    commit_seconds : float
+      most seconds between commits
+    decoder : callable, optional
+      str -> object used to read results back, json.loads if None
+    """
+
+    def __init__(self, path, commit_every=500, commit_seconds=5.0,
+                 decoder=None):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.decoder = decoder or json.loads
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._committed = time.monotonic()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, raw INTEGER, value BLOB)")
+        self._db.commit()
+
+    @staticmethod
+    def key(request_key):
+        """
+        Journal key for a data_pull.request_key tuple
+
+        Parameters
+        ----------
+        request_key : tuple
+          (method, url, body)
+        Returns
+        -------
+        key : str
+        """
+        return json.dumps(list(request_key), separators=(',', ':'))
+
+    def done(self, keys):
+        """
+        Keys that already have a journaled result
+
+        Parameters
+        ----------
+        keys : iterable of str
+        Returns
+        -------
+        done : set
+        """
+        done = set()
+        keys = iter(keys)
+        with self._lock:
+            # stay under SQLite's bound parameter limit
+            for chunk in iter(lambda: list(islice(keys, 500)), []):
+                done.update(key for key, in self._db.execute(
+                    "SELECT key FROM results WHERE key IN (%s)"
+                    % ",".join("?" * len(chunk)), chunk))
+        return done
+
+    def record(self, key, value, ok=True):
+        """
+        Journals the result of a request that succeeded
+
+        Parameters
+        ----------
+        key : str
+        value : obj
+          decoded response, or raw bytes
+        ok : bool
+          False when the request failed, nothing is journaled so it is
+          retried on the next run
+        """
+        if not ok:
+            return
+        raw = isinstance(value, (bytes, bytearray, memoryview))
+        blob = bytes(value) if raw else json.dumps(
+            value, separators=(',', ':'), default=str)
+        with self._lock:
+            self._db.execute("REPLACE INTO results VALUES (?, ?, ?)",
+                             (key, int(raw), blob))
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every or \
+                    time.monotonic() - self._committed >= self.commit_seconds:
+                self._commit()
+
+    def _commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+        self._committed = time.monotonic()
+
+    def flush(self):
+        """
+        Commits everything recorded so far
+        """
+        with self._lock:
+            self._commit()
+
+    def _decode(self, row):
+        if row is None:
+            return None
+        raw, value = row
+        return value if raw else self.decoder(value)
+
+    def get(self, key):
+        """
+        Journaled result for key, None if there is none
+
+        Parameters
+        ----------
+        key : str
+        Returns
+        -------
+        value : obj
+        """
+        with self._lock:
+            return self._decode(self._db.execute(
+                "SELECT raw, value FROM results WHERE key = ?",
+                (key,)).fetchone())
+
+    def fetch(self, keys):
+        """
+        Journaled results for keys, in order
+
+        Parameters
+        ----------
+        keys : [str]
+        Returns
+        -------
+        values : list
+          None where a key has no result
+        """
+        unique = list(dict.fromkeys(keys))
+        rows = {}
+        with self._lock:
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows.update((key, (raw, value)) for key, raw, value in
+                            self._db.execute(
+                                "SELECT key, raw, value FROM results "
+                                "WHERE key IN (%s)"
+                                % ",".join("?" * len(chunk)), chunk))
+        return [self._decode(rows.get(key)) for key in keys]
+
+    def results(self, keys):
+        """
+        Read-only list of results for keys backed by the journal, values
+        are decoded when accessed rather than held in memory
+
+        Parameters
+        ----------
+        keys : [str]
+        Returns
+        -------
+        results : JournalResults
+        """
+        return JournalResults(self, list(keys))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM results")
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._db.close()
+
+
+class JournalResults(Sequence):
+    """
+    Sequence of journaled results in request order, returned by
+    fetch_many and async_aiohttp_get_all when a checkpoint is used.
+    Iterating reads the journal in chunks of `chunk` results.
+    """
+
+    chunk = 500
+
+    def __init__(self, checkpoint, keys):
+        self.checkpoint = checkpoint
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.checkpoint.fetch(self.keys[index])
+        return self.checkpoint.get(self.keys[index])
+
+    def __iter__(self):
+        for start in range(0, len(self.keys), self.chunk):
+            yield from self.checkpoint.fetch(
+                self.keys[start:start + self.chunk])
+
+
+"""
+How to use:
+from toolbox.checkpoint import Checkpoint
+checkpoint = Checkpoint(os.path.expanduser('~/pulls/inventory.sqlite'))
+# rerun the same cell after a crash or kernel restart, finished requests
+# are skipped
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, checkpoint=checkpoint)
+for record in resp:  # read back from the journal in chunks
+    ...
+"""
@@ -0,0 +1,486 @@
+import asyncio
+import json
+import threading
+import zlib
+import aiohttp
+from requests.exceptions import ContentDecodingError
+
+# optional codecs, responses are only requested in the ones installed
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ('zstd', 'br', 'gzip', 'deflate')
+# raised by the codecs for a corrupt body or a wrong Content-Encoding,
+# EOFError by _flush for a body cut short
+CODEC_ERRORS = (zlib.error, EOFError) \
+    + ((brotli.error,) if brotli is not None else ()) \
+    + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def available():
+    """
+    Encodings whose codec is installed, gzip and deflate always are
+
+    Returns
+    -------
+    encodings : tuple of str
+    """
+    installed = {'zstd': zstandard is not None, 'br': brotli is not None}
+    return tuple(encoding for encoding in ENCODINGS
+                 if installed.get(encoding, True))
+
+
+class _BrotliDecoder:
+
+    def __init__(self):
+        self._decoder = brotli.Decompressor()
+
+    def decompress(self, chunk):
+        return self._decoder.process(chunk)
+
+    def flush(self):
+        return b''
+
+    @property
+    def eof(self):
+        return self._decoder.is_finished()
+
+
+class _Identity:
+
+    def decompress(self, chunk):
+        return chunk
+
+    def flush(self):
+        return b''
+
+
+class _Chain:
+
+    def __init__(self, decoders):
+        self.decoders = decoders
+
+    def decompress(self, chunk):
+        for decoder in self.decoders:
+            chunk = decoder.decompress(chunk)
+        return chunk
+
+    def flush(self):
+        chunk = b''
+        for decoder in self.decoders:
+            chunk = decoder.decompress(chunk) + decoder.flush()
+        return chunk
+
+    @property
+    def eof(self):
+        return all(getattr(decoder, 'eof', True)
+                   for decoder in self.decoders)
+
+
+def make_decoder(encoding):
+    """
+    Streaming decoder for one content coding
+
+    Parameters
+    ----------
+    encoding : str
+      Content-Encoding token, '' or 'identity' for none
+    Returns
+    -------
+    decoder : obj
+      decompress(chunk) -> bytes and flush() -> bytes
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return _Identity()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if encoding == 'deflate':
+        # zlib wrapped, the header is detected
+        return zlib.decompressobj(zlib.MAX_WBITS | 32)
+    if encoding == 'br' and brotli is not None:
+        return _BrotliDecoder()
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"no decoder installed for Content-Encoding "
+                     f"{encoding!r}")
+
+
+def encode(encoding, data, level=None):
+    """
+    Compresses a whole body
+
+    Parameters
+    ----------
+    encoding : str
+      'gzip', 'deflate', 'br' or 'zstd'
+    data : bytes
+    level : int, optional
+      codec's compression level, its default if None
+    Returns
+    -------
+    body : bytes
+    """
+    if encoding in ('gzip', 'deflate'):
+        encoder = zlib.compressobj(
+            -1 if level is None else level,
+            wbits=zlib.MAX_WBITS | 16 if encoding == 'gzip'
+            else zlib.MAX_WBITS)
+        return encoder.compress(data) + encoder.flush()
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(data) if level is None \
+            else brotli.compress(data, quality=level)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level).compress(data)
+    raise ValueError(f"no encoder installed for {encoding!r}")
+
+
+def _flush(decoder, wire):
+    # decompressors return what they have for a truncated stream
+    chunk = decoder.flush()
+    if wire and not getattr(decoder, 'eof', True):
+        raise EOFError("compressed body ends before its end of stream")
+    return chunk
+
+
+def _describe(response, error):
+    return (f"can't decode {response.headers.get('Content-Encoding')!r} "
+            f"body: {error!r}")
+
+
+def _payload_error(response, error):
+    # what aiohttp raises for a body it can't decompress, fetch fails
+    # just this request with it
+    return aiohttp.ClientPayloadError(_describe(response, error))
+
+
+class Compression:
+    """
+    Opt-in content encoding for data_pull requests
+
+    Responses are requested in the preferred encodings that are installed
+    and decompressed chunk by chunk as they are read, so the compressed
+    body is never held whole. Request bodies of at least
+    `request_threshold` bytes are compressed before they are sent; only
+    enable that for servers that accept a Content-Encoding on requests.
+    Bytes on the wire and decoded bytes are counted both ways.
+
+    Parameters
+    ----------
+    encodings : (str)
+      response encodings in order of preference, those not installed
+      are skipped. zstd needs zstandard and br needs brotli or
+      brotlicffi.
+    request_threshold : int, optional
+      compress request bodies at least this many bytes, None to never
+    request_encoding : str
+      encoding for request bodies
+    level : int, optional
+      compression level for request bodies, the codec's default if None
+    """
+
+    def __init__(self, encodings=('zstd', 'br', 'gzip'),
+                 request_threshold=None, request_encoding='gzip',
+                 level=None):
+        installed = available()
+        self.encodings = tuple(e for e in encodings if e in installed)
+        if request_threshold is not None \
+                and request_encoding not in installed:
+            raise ValueError(f"request_encoding {request_encoding!r} isn't "
+                             f"installed, choose from {installed}")
+        self.request_threshold = request_threshold
+        self.request_encoding = request_encoding
+        self.level = level
+        self.accept_encoding = ', '.join(self.encodings) or 'identity'
+        self.responses = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+        self.requests = 0
+        self.request_bytes = 0
+        self.request_wire_bytes = 0
+        self._lock = threading.Lock()
+
+    def headers(self, headers=None):
+        """
+        Request headers with Accept-Encoding added
+
+        Parameters
+        ----------
+        headers : dict, optional
+          headers to add to, not modified
+        Returns
+        -------
+        headers : dict
+        """
+        return {**(headers or {}), 'Accept-Encoding': self.accept_encoding}
+
+    def body(self, payload):
+        """
+        JSON request body, compressed when it reaches request_threshold
+
+        Parameters
+        ----------
+        payload : obj
+          JSON serializable request body
+        Returns
+        -------
+        (data, headers) : (bytes, dict)
+          body to send and its Content-Type and Content-Encoding headers
+        """
+        data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        sent = data
+        if self.request_threshold is not None \
+                and len(data) >= self.request_threshold:
+            sent = encode(self.request_encoding, data, self.level)
+            headers['Content-Encoding'] = self.request_encoding
+        with self._lock:
+            self.requests += 1
+            self.request_bytes += len(data)
+            self.request_wire_bytes += len(sent)
+        return sent, headers
+
+    def decoder(self, headers):
+        """
+        Streaming decoder for a response
+
+        Parameters
+        ----------
+        headers : mapping
+          response headers, Content-Encoding selects the codec
+        Returns
+        -------
+        decoder : obj
+          decompress(chunk) and flush(), codings applied in the reverse
+          of the order they are listed
+        """
+        codings = [coding for coding in
+                   headers.get('Content-Encoding', '').split(',')
+                   if coding.strip()]
+        if len(codings) <= 1:
+            return make_decoder(codings[0] if codings else '')
+        return _Chain([make_decoder(coding)
+                       for coding in reversed(codings)])
+
+    def count(self, wire, decoded):
+        """
+        Adds a response's sizes to the totals
+
+        Parameters
+        ----------
+        wire : int
+          bytes received
+        decoded : int
+          bytes after decompression
+        """
+        with self._lock:
+            self.responses += 1
+            self.wire_bytes += wire
+            self.decoded_bytes += decoded
+
+    async def read(self, response, chunk_size=2**16):
+        """
+        Reads and decompresses a response body a chunk at a time
+
+        Parameters
+        ----------
+        response : obj
+          aiohttp or transport response requested with
+          auto_decompress=False
+        chunk_size : int
+          bytes read from the socket at a time
+        Returns
+        -------
+        body : bytes
+          decoded body
+        """
+        decoder = self.decoder(response.headers)
+        parts = []
+        wire = 0
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                wire += len(chunk)
+                parts.append(decoder.decompress(chunk))
+            parts.append(_flush(decoder, wire))
+        except CODEC_ERRORS as error:
+            raise _payload_error(response, error) from error
+        body = b''.join(parts)
+        self.count(wire, len(body))
+        return body
+
+    async def iter_decoded(self, response, chunk_size=2**16):
+        """
+        Decompressed chunks of a response body as they arrive
+
+        Parameters
+        ----------
+        response : obj
+          aiohttp or transport response requested with
+          auto_decompress=False
+        chunk_size : int
+          bytes read from the socket at a time
+        Yields
+        -------
+        chunk : bytes
+        """
+        decoder = self.decoder(response.headers)
+        wire = decoded = 0
+        async for chunk in response.content.iter_chunked(chunk_size):
+            wire += len(chunk)
+            try:
+                chunk = decoder.decompress(chunk)
+            except CODEC_ERRORS as error:
+                raise _payload_error(response, error) from error
+            decoded += len(chunk)
+            if chunk:
+                yield chunk
+        try:
+            chunk = _flush(decoder, wire)
+        except CODEC_ERRORS as error:
+            raise _payload_error(response, error) from error
+        decoded += len(chunk)
+        self.count(wire, decoded)
+        if chunk:
+            yield chunk
+
+    def read_sync(self, response, chunk_size=2**16):
+        """
+        Blocking counterpart of read() for a requests response made with
+        stream=True
+
+        Parameters
+        ----------
+        response : obj
+          requests.Response
+        chunk_size : int
+          bytes read at a time
+        Returns
+        -------
+        body : bytes
+          decoded body
+        """
+        decoder = self.decoder(response.headers)
+        parts = []
+        wire = 0
+        try:
+            for chunk in response.raw.stream(chunk_size,
+                                             decode_content=False):
+                wire += len(chunk)
+                parts.append(decoder.decompress(chunk))
+            parts.append(_flush(decoder, wire))
+        except CODEC_ERRORS as error:
+            # what requests raises when it decodes a bad body itself
+            raise ContentDecodingError(
+                _describe(response, error), response=response) from error
+        body = b''.join(parts)
+        self.count(wire, len(body))
+        return body
+
+    def stats(self):
+        """
+        Bytes on the wire against decoded bytes
+
+        Returns
+        -------
+        stats : dict
+          response and request counts, wire and decoded bytes in both
+          directions and the decoded / wire ratio of responses
+        """
+        with self._lock:
+            return {
+                'encodings': self.encodings,
+                'responses': self.responses,
+                'wire_bytes': self.wire_bytes,
+                'decoded_bytes': self.decoded_bytes,
+                'ratio': self.decoded_bytes / self.wire_bytes
+                if self.wire_bytes else None,
+                'requests': self.requests,
+                'request_bytes': self.request_bytes,
+                'request_wire_bytes': self.request_wire_bytes,
+            }
+
+
+def _test():
+    class Content:
+
+        def __init__(self, body):
+            self.body = body
+
+        async def iter_chunked(self, n):
+            for start in range(0, len(self.body), n):
+                yield self.body[start:start + n]
+
+    class Raw:
+
+        def __init__(self, body):
+            self.body = body
+
+        def stream(self, n, decode_content=True):
+            return (self.body[start:start + n]
+                    for start in range(0, len(self.body), n))
+
+    class Response:
+
+        def __init__(self, encoding, body):
+            self.headers = {'Content-Encoding': encoding}
+            self.content = Content(body)
+            self.raw = Raw(body)
+
+    async def read_all(compression, response):
+        return await compression.read(response, 7), b''.join(
+            [chunk async for chunk in compression.iter_decoded(response, 7)])
+
+    compression = Compression(encodings=available())
+    data = json.dumps([{'id': i} for i in range(200)]).encode('utf-8')
+    for encoding in compression.encodings:
+        body = encode(encoding, data)
+        response = Response(encoding, body)
+        if asyncio.run(read_all(compression, response)) != (data, data) \
+                or compression.read_sync(response, 7) != data:
+            return f"{encoding} round trip"
+
+    # labelled gzip but isn't, and gzip cut short
+    for corrupt in (data, encode('gzip', data)[:-12] + b'x' * 12):
+        response = Response('gzip', corrupt)
+        for read in (compression.read, compression.iter_decoded):
+            try:
+                if read == compression.read:
+                    asyncio.run(read(response))
+                else:
+                    asyncio.run(read_all(compression, response))
+                return "corrupt gzip body decoded"
+            except aiohttp.ClientPayloadError:
+                pass
+        try:
+            compression.read_sync(response)
+            return "corrupt gzip body decoded"
+        except ContentDecodingError:
+            pass
+    return "Success"
+
+
+"""
+How to use:
+from toolbox.content_encoding import Compression
+compression = Compression(encodings=('zstd', 'br', 'gzip'),
+                          request_threshold=2**14)
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, [bulk_url], cert_path, post=True, post_jsons=queries,
+    compression=compression)
+timings['compression']
+>>> {'encodings': ('zstd', 'gzip'), 'responses': 200,
+     'wire_bytes': 3811520, 'decoded_bytes': 40110336, 'ratio': 10.5,
+     'requests': 200, 'request_bytes': 9830400,
+     'request_wire_bytes': 1219200}
+"""
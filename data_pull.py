@@ -1,38 +1,134 @@
 import time
 import asyncio
 import aiohttp
-import nest_asyncio
-import ssl
 import socket
-import certifi
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from itertools import islice
+import json
 # import os
-from async_retrying import retry
-from .pkcs12_handler import pfx_to_pem
+from urllib.parse import urlsplit
+from .retry_policy import RetryPolicy, HTTPStatusError, CircuitOpenError
+from .runner import run_sync, sync_iter
+from .scheduler import AdaptiveScheduler
+from .timing import RequestTimer, trace_config
+from .transport import DNSCache, HTTP2Client, Transport
 import pdb
 
-nest_asyncio.apply()
-durations = []
-server_response_errors = 0
-timeout_errors = 0
+# fastest available JSON decoder, all of these accept bytes
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from msgspec.json import decode as loads
+    except ImportError:
+        from json import loads
+
+# raised for a malformed body: json's, orjson's and requests' errors are
+# ValueErrors, msgspec's isn't
+try:
+    from msgspec import DecodeError
+    DECODE_ERRORS = (ValueError, DecodeError)
+except ImportError:
+    DECODE_ERRORS = (ValueError,)
+
+try:
+    from asyncio import timeout as time_limit
+except ImportError:  # Python < 3.11, aiohttp installs async_timeout there
+    from async_timeout import timeout as time_limit
+
+# most recent timed() calls, oldest dropped first
+durations = deque(maxlen=1000)
+cache_stats = {}
+# what fetch_many asks fetch to return for a failed request, so a JSON null
+# body isn't mistaken for a failure
+_FAILED = object()
+# shared by every call that doesn't pass its own, so circuit breakers and
+# the retry budget see all traffic to a host
+default_retry_policy = RetryPolicy(
+    retry_on=(aiohttp.ClientError, asyncio.TimeoutError, OSError))
 
 
 def timed(func):
     """
-    records approximate durations of function calls
+    records durations of function calls in data_pull.durations as
+    {'function': name, 'seconds': float}
     """
 
     def wrapper(*args, **kwargs):
-        start = time.time()
+        start = time.perf_counter_ns()
         result = func(*args, **kwargs)
-        duration = f"finished in {time.time() - start:.2f} seconds"
-        durations.append(duration)
+        durations.append({
+            'function': func.__name__,
+            'seconds': (time.perf_counter_ns() - start) / 1e9})
         return result
 
     return wrapper
 
 
-@retry(attempts=15)
-async def fetch(self, url, session, get=False, post=False, post_json={}):
+def _advance(self, n=1):
+    if hasattr(self, "progressBar"):
+        self.progressBar.update(n)
+
+
+async def decode_body(body, decoder=None, offload_bytes=2**20,
+                      executor=None):
+    """
+    decodes a response body, moving large bodies off the event loop
+
+    Parameters
+    ----------
+    body : bytes
+      raw response body
+    decoder : callable, optional
+      bytes -> object, defaults to orjson/msgspec/json whichever is
+      installed. Pass bytes or memoryview to skip decoding.
+    offload_bytes : int
+      bodies at least this large are decoded in `executor`, None to
+      always decode on the event loop
+    executor : concurrent.futures.Executor, optional
+      pool for large bodies, the loop's default thread pool if None. A
+      ProcessPoolExecutor frees the loop from the GIL as well.
+    Returns
+    -------
+    value : obj
+      decoded body
+    """
+    decoder = decoder or loads
+    if decoder in (bytes, memoryview):
+        return decoder(body)
+    if offload_bytes is not None and len(body) >= offload_bytes:
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, decoder, body)
+    return decoder(body)
+
+
+def request_key(call):
+    """
+    identity of a request for coalescing: method, URL and the post body
+    serialized with sorted keys
+
+    Parameters
+    ----------
+    call : dict
+      keyword arguments for fetch
+    Returns
+    -------
+    key : tuple
+    """
+    body = call.get('post_json')
+    if body is not None:
+        body = json.dumps(body, sort_keys=True, separators=(',', ':'),
+                          default=str)
+    return ('POST' if call.get('post') else 'GET', call['url'], body)
+
+
+async def fetch(self, url, session, get=False, post=False, post_json={},
+                scheduler=None, cache=None, retry_policy=None,
+                rate_limiter=None, timer=None, decoder=None,
+                offload_bytes=2**20, executor=None, timeout=None,
+                hedging=None, compression=None, failed=None):
     """
     asynchronous get request
 
@@ -48,59 +144,145 @@ async def fetch(self, url, session, get=False, post=False, post_json={}):
       Set to perform post request
     post_json : dict
       Dict to use with post request
+    scheduler : AdaptiveScheduler, optional
+      Holds a concurrency slot for the duration of each try
+    cache : ResponseCache, optional
+      Serves fresh get responses and revalidates stale ones
+    retry_policy : RetryPolicy, optional
+      Backoff, retry budget and circuit breakers,
+      data_pull.default_retry_policy if None
+    rate_limiter : RateLimiter, optional
+      Paces every try to the host's or endpoint's allowed rate
+    timer : RequestTimer, optional
+      Records the phases of every try
+    decoder : callable, optional
+      bytes -> object, see decode_body. bytes or memoryview returns the
+      raw body.
+    offload_bytes : int
+      bodies at least this large are decoded in `executor`
+    executor : concurrent.futures.Executor, optional
+      pool large bodies are decoded in
+    timeout : float, optional
+      seconds a try may take once it holds a concurrency slot, a try
+      that takes longer fails with asyncio.TimeoutError and is retried
+    hedging : HedgePolicy, optional
+      sends a second copy of a try that is slower than the host's
+      running p95 latency
+    compression : Compression, optional
+      negotiates the response encoding and decompresses the body as it
+      is read, compresses large post bodies
+    failed : obj, optional
+      returned when the request fails, tells a failure apart from a JSON
+      null body
     Returns
     -------
     response_json : dict
-      JSON dictionary response
+      JSON dictionary response, `failed` if the request failed or its
+      body couldn't be decoded
     """
-    global server_response_errors
-    global timeout_errors
+    if not (get or post):
+        return failed
+    if scheduler is None:
+        scheduler = AdaptiveScheduler()
+    policy = retry_policy or default_retry_policy
+    # bodies are read undecoded so compression can count wire bytes
+    raw = {} if compression is None else {'auto_decompress': False}
+    if post and compression is not None:
+        data, post_headers = compression.body(post_json)
+
+    entry, fresh = await cache.alookup(url) if get and cache \
+        else (None, False)
+    if fresh:
+        _advance(self)
+        return entry.value
+
+    async def attempt(sent=None, copy=False):
+        if rate_limiter is not None:
+            await rate_limiter.acquire(url)
+        async with scheduler.slot(url, shared=copy) as slot, \
+                time_limit(timeout):
+            start = time.perf_counter_ns()
+            if sent is not None:
+                sent()
+            if get:
+                headers = entry.conditional_headers() if entry else None
+                if compression is not None:
+                    headers = compression.headers(headers)
+                request = session.get(
+                    url, timeout=None, trace_request_ctx=timer,
+                    headers=headers, **raw)
+            elif compression is not None:
+                request = session.post(
+                    url, timeout=None, trace_request_ctx=timer, data=data,
+                    headers=compression.headers(post_headers), **raw)
+            else:
+                request = session.post(
+                    url, timeout=None, trace_request_ctx=timer,
+                    json=post_json)
+            async with request as response:
+                slot.status = response.status
+                if response.status == 304 and entry is not None:
+                    return cache.revalidate(entry, response.headers)
+                if not response.ok:
+                    raise HTTPStatusError(
+                        response.status, url,
+                        response.headers.get('Retry-After'))
+                received = time.perf_counter_ns()
+                body = await response.read() if compression is None \
+                    else await compression.read(response)
+                headers = response.headers
+        read = time.perf_counter_ns()
+        response_json = await decode_body(
+            body, decoder=decoder, offload_bytes=offload_bytes,
+            executor=executor)
+        if timer is not None:
+            decoded = time.perf_counter_ns()
+            timer.record_url(url, 'transfer', read - received)
+            timer.record_url(url, 'decode', decoded - read)
+            timer.record_url(url, 'total', decoded - start)
+        if get and cache:
+            cache.store(url, headers, body, response_json)
+        return response_json
+
+    def hedged():
+        return hedging.run(attempt, url)
 
     try:
-        if get:
-            async with session.get(url, timeout=None) as response:
-                if response.ok:
-                    response_json = await response.json()
-                    if hasattr(self, "progressBar"):
-                        self.progressBar.update(1)
-                    return response_json
-                else:
-                    time.sleep(1)
-                    server_response_errors += 1
-                    if server_response_errors > 3:
-                        print(
-                            """/nToo many server response errors occurred.
-                             Please restart your Kenrel and try again.
-                             If the problem persists contact your developer."""
-                        )
-                    else:
-                        await fetch(self, url, session, get=True)
-        elif post:
-            async with session.post(
-                url, timeout=None, json=post_json, raise_for_status=True
-            ) as response:
-                if response.ok:
-                    response_json = await response.json()
-                    if hasattr(self, "progressBar"):
-                        self.progressBar.update(1)
-                    return response_json
-    except asyncio.TimeoutError:
-        print(
-            """/nToo many server response errors occurred.
-               Please restart your Kenrel and try again.
-               If the problem persists contact your developer."""
-        )
+        response_json = await policy.run(
+            hedged if hedging is not None and (get or hedging.posts)
+            else attempt, url)
+    except (CircuitOpenError,) + policy.retry_on as error:
+        print(f"\nRequest to {url} failed: {error!r}")
+        return failed
+    except DECODE_ERRORS as error:
+        print(f"\nResponse from {url} couldn't be decoded: {error!r}")
+        return failed
+    _advance(self)
+    return response_json
 
 
 async def fetch_many(
-        self, loop, urls, cert, get=False, post=False, post_jsons=[{}]):
+        self, loop=None, urls=(), cert=None, get=False, post=False,
+        post_jsons=[{}], max_concurrency=100, max_per_host=0,
+        scheduler=None, cache=None, coalesce=True, batching=None,
+        checkpoint=None, deadline=None, **fetch_kwargs):
     """
     many asynchronous get requests, gathered
 
+    Requests are issued by at most `max_concurrency` worker tasks whose
+    slots are handed out by an AdaptiveScheduler, so memory stays bounded
+    and the concurrency settles near what the server can sustain.
+    Identical requests are sent once and share the decoded response.
+    With `batching`, post payloads are packed into array requests and the
+    batched responses are split back into per-payload results. With a
+    `checkpoint`, results go to the journal instead of memory and requests
+    it already holds are skipped. After `deadline` seconds the requests
+    still outstanding are cancelled and their results are None.
+
     Parameters
     ----------
-    loop : obj
-      asyncio.get_event_loop() object
+    loop : obj, optional
+      event loop to run the workers on, the running loop if None
     urls : [str]
       List of URLs to create session.get() tasks with
     cert : str
@@ -111,84 +293,542 @@ async def fetch_many(
       Set to perform post request
     post_jsons : [dict]
       list of dictionaries to use with post requests
+    max_concurrency : int
+      most requests in flight at once
+    max_per_host : int
+      most requests in flight to a single host, 0 for max_concurrency
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    cache : ResponseCache, optional
+      Serves fresh get responses and revalidates stale ones
+    coalesce : bool
+      Send duplicate requests (same method, URL and body) only once
+    batching : PostBatching, optional
+      pack post_jsons into batched requests to a bulk endpoint
+    checkpoint : Checkpoint, optional
+      journal of completed requests to resume from and record into
+    deadline : float, optional
+      seconds the whole call may take, retries included
+    **fetch_kwargs
+      passed to fetch, e.g. timeout, hedging, compression, retry_policy,
+      rate_limiter, timer, decoder, offload_bytes, executor
     Returns
     -------
-    asyncio.gather(*tasks) : obj
-      Response object
+    results : list
+      Responses in the same order as urls or post_jsons, a JournalResults
+      sequence read from the checkpoint when one is given
     """
+    loop = loop or asyncio.get_running_loop()
+    if scheduler is None:
+        scheduler = AdaptiveScheduler(
+            max_concurrency=max_concurrency, max_per_host=max_per_host)
+
+    if get:
+        calls = [dict(url=url, get=True) for url in urls]
+    elif post:
+        calls = [dict(url=urls[0], post=True, post_json=post_json)
+                 for post_json in post_jsons]
+    else:
+        return []
+
+    keys = [request_key(call) for call in calls] if coalesce \
+        else range(len(calls))
+    unique = {}
+    copies = {}
+    for key, call in zip(keys, calls):
+        unique.setdefault(key, call)
+        copies[key] = copies.get(key, 0) + 1
+
+    if checkpoint is not None:
+        journal = {key: checkpoint.key(request_key(call))
+                   for key, call in unique.items()}
+        done = checkpoint.done(journal.values())
+        resumed = 0
+        for key in [key for key in unique if journal[key] in done]:
+            del unique[key]
+            resumed += copies[key]
+        if resumed:
+            _advance(self, resumed)
+
+    batched = post and batching is not None
+    if batched:
+        # distinct payloads are packed, duplicates still share one result
+        members = list(unique)
+        payloads = [unique[key]['post_json'] for key in members]
+        work = []
+        for group in batching.pack(payloads):
+            body = batching.body([payloads[i] for i in group])
+            work.append(([members[i] for i in group],
+                         dict(url=urls[0], post=True, post_json=body)))
+    else:
+        work = [((key,), call) for key, call in unique.items()]
+
+    async with client_session(self, cert, scheduler) as session:
+        results = {}
+        pending = iter(work)
+        finished = 0
+
+        async def worker():
+            nonlocal finished
+            for group, call in pending:
+                response = await fetch(
+                    self, session=session, scheduler=scheduler, cache=cache,
+                    failed=_FAILED, **call, **fetch_kwargs)
+                if response is _FAILED:
+                    parts = (_FAILED,) * len(group)
+                elif batched:
+                    parts = batching.split(response, len(group),
+                                           missing=_FAILED)
+                else:
+                    parts = (response,)
+                for key, part in zip(group, parts):
+                    ok = part is not _FAILED
+                    if checkpoint is None:
+                        results[key] = part if ok else None
+                    else:
+                        checkpoint.record(journal[key], part if ok else None,
+                                          ok)
+                extra = sum(copies[key] for key in group) - 1
+                if extra:
+                    _advance(self, extra)
+                finished += 1
 
-    with pfx_to_pem(cert, self.pw) as cert:
-        sslcontext = ssl.create_default_context(cafile=certifi.where())
-        sslcontext.load_cert_chain(certfile=cert)
-
-        conn = aiohttp.TCPConnector(
-            ssl_context=sslcontext, family=socket.AF_INET,
-            limit=100, limit_per_host=0
-        )
-        if get:
-            async with aiohttp.ClientSession(connector=conn) as session:
-                tasks = [loop.create_task(fetch(self, url, session, get=True))
-                         for url in urls]
-                return await asyncio.gather(*tasks)
-        elif post:
-            async with aiohttp.ClientSession(connector=conn) as session:
-                tasks = [
-                    loop.create_task(
-                        fetch(self, urls[0], session, post=True,
-                              post_json=post_json))
-                    for post_json in post_jsons
-                ]
-                return await asyncio.gather(*tasks)
+        workers = [loop.create_task(worker()) for _ in range(
+            min(scheduler.max_concurrency, len(work)))]
+        started = loop.time()
+        try:
+            await asyncio.wait_for(asyncio.gather(*workers), deadline)
+        except asyncio.TimeoutError:
+            if deadline is None or loop.time() - started < deadline:
+                raise
+            print(f"\nDeadline of {deadline}s passed with "
+                  f"{len(work) - finished} of {len(work)} requests "
+                  "unfinished")
+        finally:
+            if checkpoint is not None:
+                checkpoint.flush()
+    if checkpoint is not None:
+        return checkpoint.results(journal[key] for key in keys)
+    return [results.get(key) for key in keys]
+
+
+async def iter_fetch(self, urls, cert, get=False, post=False, post_jsons=(),
+                     window=100, max_per_host=0, scheduler=None, cache=None,
+                     **fetch_kwargs):
+    """
+    streams asynchronous requests, yielding each response as it finishes
+
+    At most `window` requests are in flight, and `urls`/`post_jsons` are
+    consumed lazily, so memory stays flat however long the input is.
+    Responses arrive in completion order, not input order. A request
+    identical to one already in flight waits on it instead of being sent.
+
+    Parameters
+    ----------
+    urls : iterable of str
+      URLs to get, or a list whose first URL every post is sent to
+    cert : str
+      filepath for certificate
+    get : bool
+      Set to perform get request
+    post : bool
+      Set to perform post request
+    post_jsons : iterable of dict
+      dictionaries to use with post requests
+    window : int
+      most requests in flight at once
+    max_per_host : int
+      most requests in flight to a single host, 0 for window
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    cache : ResponseCache, optional
+      Serves fresh get responses and revalidates stale ones
+    **fetch_kwargs
+      passed to fetch, e.g. timeout, hedging, compression, retry_policy,
+      rate_limiter, timer, decoder, offload_bytes, executor
+    Yields
+    -------
+    (item, response_json) : tuple
+      URL (get) or post dict (post) and its JSON response
+    """
+    if scheduler is None:
+        scheduler = AdaptiveScheduler(
+            max_concurrency=window, max_per_host=max_per_host)
+
+    if get:
+        calls = (dict(url=url, get=True) for url in urls)
+    elif post:
+        url = next(iter(urls))
+        calls = (dict(url=url, post=True, post_json=post_json)
+                 for post_json in post_jsons)
+    else:
+        return
+
+    async with client_session(self, cert, scheduler) as session:
+        # task -> (key, items waiting on it), key -> task
+        in_flight = {}
+        by_key = {}
+        waiting = 0
+
+        def submit():
+            nonlocal waiting
+            for call in islice(calls, window - waiting):
+                item = call.get('post_json', call['url'])
+                key = request_key(call)
+                waiting += 1
+                if key in by_key:
+                    in_flight[by_key[key]][1].append(item)
+                    continue
+                task = asyncio.ensure_future(fetch(
+                    self, session=session, scheduler=scheduler, cache=cache,
+                    **call, **fetch_kwargs))
+                in_flight[task] = (key, [item])
+                by_key[key] = task
+
+        try:
+            submit()
+            while in_flight:
+                done, _ = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    key, items = in_flight.pop(task)
+                    del by_key[key]
+                    waiting -= len(items)
+                    if len(items) > 1:
+                        _advance(self, len(items) - 1)
+                    for item in items:
+                        yield item, task.result()
+                submit()
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+
+class AsyncClient(Transport):
+    """
+    Long-lived aiohttp session for a PKI certificate, the default transport
+
+    The certificate is decrypted and the SSL context built once, and the
+    connector keeps connections alive between batches, so repeated calls
+    to async_aiohttp_get_all skip the TCP and TLS handshakes. New
+    connections resume an earlier TLS session, and DNS answers are
+    cached across connectors.
+
+    Parameters
+    ----------
+    cert : str
+      filepath for certificate
+    pw : str
+      password to unlock the certificate
+    keepalive_timeout : float
+      seconds an idle connection is kept open
+    dns_ttl : int
+      seconds resolved host addresses are cached
+    cafile : str, optional
+      CA bundle servers are verified against, certifi's if None
+    """
+
+    def __init__(self, cert, pw, keepalive_timeout=60, dns_ttl=300,
+                 cafile=None):
+        super().__init__(cert, pw, cafile)
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.resolver = DNSCache(ttl=dns_ttl)
+
+    async def session(self, limit=100):
+        """
+        Returns the shared ClientSession, creating it on first use or when
+        the event loop changed or more connections are needed. Hold it
+        with use() so a replacement doesn't close it mid-request.
+
+        Parameters
+        ----------
+        limit : int
+          minimum size of the connection pool
+        Returns
+        -------
+        session : obj
+          aiohttp.ClientSession
+        """
+        loop = asyncio.get_running_loop()
+        if (self._session is None or self._session.closed
+                or self._loop is not loop
+                or self._session.connector.limit < limit):
+            await self._retire(loop)
+            conn = aiohttp.TCPConnector(
+                ssl_context=self.sslcontext, family=socket.AF_INET,
+                limit=limit, limit_per_host=0,
+                keepalive_timeout=self.keepalive_timeout,
+                resolver=self.resolver, use_dns_cache=False
+            )
+            # phases are recorded into the RequestTimer each request
+            # passes as trace_request_ctx, requests without one are free
+            self._session = aiohttp.ClientSession(
+                connector=conn, trace_configs=[trace_config()])
+            self._loop = loop
+        return self._session
+
+
+# Session(transport=...) names the client requests are sent through
+TRANSPORTS = {'aiohttp': AsyncClient, 'http2': HTTP2Client}
+
+
+def get_client(self, cert):
+    """
+    Transport cached on the Session object, rebuilt when the certificate,
+    password or transport changes, the replaced client's connections are
+    closed. Session.transport picks the client from TRANSPORTS, aiohttp
+    if it isn't set.
+
+    Parameters
+    ----------
+    cert : str
+      filepath for certificate
+    Returns
+    -------
+    client : Transport
+      AsyncClient or HTTP2Client
+    """
+    transport = TRANSPORTS[getattr(self, "transport", "aiohttp")]
+    client = getattr(self, "async_client", None)
+    if client is None or type(client) is not transport \
+            or client.cert != cert or client.pw != self.pw:
+        if client is not None:
+            client.retire()
+        client = transport(cert, self.pw)
+        self.async_client = client
+    return client
+
+
+@asynccontextmanager
+async def client_session(self, cert, scheduler):
+    """
+    aiohttp ClientSession, or the HTTP/2 equivalent, authenticated with
+    the user's PKI certificate and shared across calls through the Session
+    object's transport
+
+    Parameters
+    ----------
+    cert : str
+      filepath for certificate
+    scheduler : AdaptiveScheduler
+      its max_concurrency sizes the connection pool
+    Returns
+    -------
+    session : obj
+      aiohttp.ClientSession
+    """
+    client = get_client(self, cert)
+    async with client.use(limit=scheduler.max_concurrency) as session:
+        yield session
+
+
+async def prewarm(self, urls, cert, connections=10, max_concurrency=100,
+                  path='/', method='HEAD'):
+    """
+    Resolves the hosts of urls and opens keep-alive connections to them
+    ahead of a burst of requests, so the burst doesn't start with a wave
+    of DNS lookups and full mutual-TLS handshakes
+
+    The connections stay in the Session object's transport for the
+    requests that follow on the same event loop; from synchronous code
+    run both through runner.run_sync or the sync wrappers. After the
+    first handshake to a host the rest resume its TLS session.
+
+    Parameters
+    ----------
+    urls : iterable of str
+      URLs the burst will request, only their hosts are used
+    cert : str
+      filepath for certificate
+    connections : int
+      connections to open per host, the HTTP/2 transport multiplexes
+      them over one
+    max_concurrency : int
+      max_concurrency of the requests that follow, it sizes the pool and
+      a larger one later replaces the warmed pool
+    path : str
+      path requested on every host to open a connection
+    method : str
+      request method for the warm-up requests, any answer counts
+    Returns
+    -------
+    hosts : dict
+      {origin: {'opened': requests answered, 'failed': requests that
+      couldn't connect}}
+    """
+    client = get_client(self, cert)
+    origins = {}
+    for url in urls:
+        parts = urlsplit(url)
+        origins.setdefault(f"{parts.scheme}://{parts.netloc}", parts)
+
+    resolver = getattr(client, 'resolver', None)
+    if resolver is not None:
+        await asyncio.gather(*[
+            resolver.resolve(parts.hostname, parts.port or (
+                443 if parts.scheme == 'https' else 80), socket.AF_INET)
+            for parts in origins.values()], return_exceptions=True)
+
+    async def touch(origin):
+        try:
+            async with session.request(method, origin + path,
+                                       timeout=None) as response:
+                await response.read()
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            return False
+
+    async with client.use(limit=max_concurrency) as session:
+        answered = await asyncio.gather(*[
+            asyncio.gather(*[touch(origin) for _ in range(connections)])
+            for origin in origins])
+    return {origin: {'opened': sum(opened),
+                     'failed': len(opened) - sum(opened)}
+            for origin, opened in zip(origins, answered)}
 
 
 @timed
-def sync_requests_get_all(urls, session):
+def sync_requests_get_all(urls, session, cache=None, retry_policy=None,
+                          rate_limiter=None, workers=1, compression=None):
     """
     performs syncronous get requests
+
+    With workers > 1 the requests run on a thread pool that shares the
+    session, whose connection pools are grown to match.
+
     Parameters
     ----------
     urls : [str]
       List of URLs to create session.get() tasks with
     session : obj
       Session object to make session.get()
+    cache : ResponseCache, optional
+      Serves fresh responses and revalidates stale ones
+    retry_policy : RetryPolicy, optional
+      Backoff, retry budget and circuit breakers,
+      data_pull.default_retry_policy if None
+    rate_limiter : RateLimiter, optional
+      Paces every try to the host's or endpoint's allowed rate
+    workers : int
+      threads making requests in parallel, 1 for one at a time
+    compression : Compression, optional
+      negotiates the response encoding and decompresses the body as it
+      is read
     Returns
     -------
     json : {}
-      JSON dictionary response
+      JSON dictionary response, None for requests that failed
   """
-    return [session.get(url).json() for url in urls]
+    policy = retry_policy or default_retry_policy
+
+    def get_json(url):
+        entry, fresh = cache.lookup(url) if cache else (None, False)
+        if fresh:
+            return entry.value
+
+        def attempt():
+            if rate_limiter is not None:
+                rate_limiter.acquire_sync(url)
+            headers = entry.conditional_headers() if entry else None
+            if compression is not None:
+                headers = compression.headers(headers)
+            response = session.get(url, headers=headers,
+                                   stream=compression is not None)
+            if response.status_code == 304 and entry is not None:
+                response.close()
+                return cache.revalidate(entry, response.headers)
+            if not response.ok:
+                response.close()
+                raise HTTPStatusError(
+                    response.status_code, url,
+                    response.headers.get('Retry-After'))
+            # decoded with loads, not response.json(), whose
+            # JSONDecodeError is also an OSError and would be retried
+            body = response.content if compression is None \
+                else compression.read_sync(response)
+            response_json = loads(body)
+            if cache:
+                cache.store(url, response.headers, body, response_json)
+            return response_json
+
+        try:
+            return policy.call(attempt, url)
+        except (CircuitOpenError,) + policy.retry_on as error:
+            print(f"\nRequest to {url} failed: {error!r}")
+            return None
+        except DECODE_ERRORS as error:
+            print(f"\nResponse from {url} couldn't be decoded: {error!r}")
+            return None
+
+    if workers > 1:
+        size_pool(session, workers)
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(get_json, urls))
+    else:
+        results = [get_json(url) for url in urls]
+    if cache is not None:
+        cache_stats.update(cache.stats())
+    return results
+
+
+def size_pool(session, workers):
+    """
+    grows the connection pools of a requests.Session's adapters so every
+    worker thread can hold a connection to the same host
+
+    Parameters
+    ----------
+    session : obj
+      requests.Session
+    workers : int
+      threads sharing the session
+    """
+    for adapter in set(session.adapters.values()):
+        if getattr(adapter, '_pool_maxsize', workers) < workers:
+            adapter.init_poolmanager(
+                adapter._pool_connections, workers,
+                block=adapter._pool_block)
 
 
 @timed
-def async_requests_get_all(urls, session):
+def async_requests_get_all(urls, session, workers=10):
     """
-    asynchronous wrapper around synchronous requests
+    asynchronous wrapper around synchronous requests, each session.get()
+    runs on a thread pool so the requests overlap
     Parameters
     ----------
     urls : [str]
       List of URLs to create session.get() tasks with
     session : obj
       Session object to make session.get()
+    workers : int
+      threads making requests in parallel
     Returns
     -------
-    loop.run_until_complete(asyncio.gather(*tasks)) : obj
-      Response object
+    responses : [obj]
+      Response objects
     """
-    loop = asyncio.get_event_loop()
     # use session to reduce network overhead
+    size_pool(session, workers)
 
-    async def async_get(url):
-        return session.get(url)
+    async def gather():
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(workers) as executor:
+            return await asyncio.gather(*[
+                loop.run_in_executor(executor, session.get, url)
+                for url in urls])
 
-    async_tasks = [loop.create_trask(async_get(url)) for url in urls]
-    return loop.run_until_complete(asyncio.gather(*async_tasks))
+    return run_sync(gather())
 
 
-@timed
-def async_aiohttp_get_all(
-        self, urls, cert, get=False, post=False, post_jsons=[{}]):
+async def get_all(
+        self, urls, cert, get=False, post=False, post_jsons=[{}],
+        max_concurrency=100, max_per_host=0, scheduler=None, cache=None,
+        timer=None, **fetch_kwargs):
     """
-    asynchronous requests
+    asynchronous requests, awaitable from a running event loop such as a
+    Jupyter cell
 
     Parameters
     ----------
@@ -202,24 +842,122 @@ def async_aiohttp_get_all(
       Set to perform post request
     post_jsons : [dict]
       list of dictionaries to use with post requests
+    max_concurrency : int
+      most requests in flight at once
+    max_per_host : int
+      most requests in flight to a single host, 0 for max_concurrency
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    cache : ResponseCache, optional
+      Serves fresh get responses and revalidates stale ones, counters are
+      copied to data_pull.cache_stats
+    timer : RequestTimer, optional
+      collects the phase timings, a new one per call if None
+    **fetch_kwargs
+      passed to fetch_many, e.g. coalesce, batching, checkpoint,
+      deadline, timeout, hedging, compression, retry_policy,
+      rate_limiter, decoder, offload_bytes, executor
     Returns
     -------
     resp : obj
       Response object
+    timings : dict
+      RequestTimer.summary(): wall seconds and per-host count and
+      mean/p50/p95/p99/max milliseconds for the queued, dns, connect,
+      ttfb, transfer, decode and total phases, plus cache counters when a
+      cache is used and wire against decoded bytes when compression is
     """
-    global server_response_errors
-    server_response_errors = 0
-    loop = asyncio.get_event_loop()
-    if get:
-        resp = loop.run_until_complete(
-            fetch_many(self, loop, urls, cert, get=True))
-    elif post:
-        resp = loop.run_until_complete(fetch_many(
-            self, loop, urls, cert, post=True, post_jsons=post_jsons))
-    return resp, durations
+    timer = timer or RequestTimer()
+    resp = await fetch_many(
+        self, urls=urls, cert=cert, get=get, post=post,
+        post_jsons=post_jsons, max_concurrency=max_concurrency,
+        max_per_host=max_per_host, scheduler=scheduler, cache=cache,
+        timer=timer, **fetch_kwargs)
+    timings = timer.summary()
+    if cache is not None:
+        cache_stats.update(cache.stats())
+        timings['cache'] = cache.stats()
+    if fetch_kwargs.get('compression') is not None:
+        timings['compression'] = fetch_kwargs['compression'].stats()
+    return resp, timings
+
+
+def async_aiohttp_get_all(
+        self, urls, cert, get=False, post=False, post_jsons=[{}],
+        max_concurrency=100, max_per_host=0, scheduler=None, cache=None,
+        timer=None, **fetch_kwargs):
+    """
+    asynchronous requests from synchronous code, see get_all. Starts an
+    event loop only when none is running.
+
+    Returns
+    -------
+    resp : obj
+      Response object
+    timings : dict
+      RequestTimer.summary() plus cache counters when a cache is used
+    """
+    return run_sync(get_all(
+        self, urls, cert, get=get, post=post, post_jsons=post_jsons,
+        max_concurrency=max_concurrency, max_per_host=max_per_host,
+        scheduler=scheduler, cache=cache, timer=timer, **fetch_kwargs))
+
+
+def iter_aiohttp_get_all(
+        self, urls, cert, get=False, post=False, post_jsons=(), window=100,
+        max_per_host=0, scheduler=None, cache=None, **fetch_kwargs):
+    """
+    synchronous generator over iter_fetch for code that can't use async for
+
+    Parameters
+    ----------
+    urls : iterable of str
+      URLs to get, or a list whose first URL every post is sent to
+    cert : str
+      filepath for certificate
+    get : bool
+      Set to perform get request
+    post : bool
+      Set to perform post request
+    post_jsons : iterable of dict
+      dictionaries to use with post requests
+    window : int
+      most requests in flight at once
+    max_per_host : int
+      most requests in flight to a single host, 0 for window
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    cache : ResponseCache, optional
+      Serves fresh get responses and revalidates stale ones
+    **fetch_kwargs
+      passed to fetch, e.g. timeout, hedging, compression, retry_policy,
+      rate_limiter, timer, decoder, offload_bytes, executor
+    Yields
+    -------
+    (item, response_json) : tuple
+      URL (get) or post dict (post) and its JSON response
+    """
+    return sync_iter(iter_fetch(
+        self, urls, cert, get=get, post=post, post_jsons=post_jsons,
+        window=window, max_per_host=max_per_host, scheduler=scheduler,
+        cache=cache, **fetch_kwargs))
 
 
 """
 import data_pull
 from session import Session, get_cert_location
+
+# stream responses as they finish instead of waiting for the whole batch
+for url, response_json in data_pull.iter_aiohttp_get_all(
+        session_module, (f"{base}/item/{i}" for i in ids), cert_path,
+        get=True, window=200):
+    rows.append(flatten(response_json))
+
+# inside a running loop, e.g. a Jupyter cell, await the async API
+resp, timings = await data_pull.get_all(session_module, urls, cert_path,
+                                        get=True)
+
+# connections stay open on session_module.async_client between calls;
+# close them when done
+run_sync(session_module.async_client.close())
 """
@@ -1,116 +1,432 @@
+from itertools import count
 import pandas as pd
 import pdb
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+OUTPUTS = ('pandas', 'arrow', 'columns')
+
+
+def _text(x):
+    try:
+        return str(x)
+    except Exception:
+        return x.encode("ascii", "ignore").decode("ascii")
+
+
+def _items(x):
+    return iter(x.items()) if isinstance(x, dict) else enumerate(x)
+
+
+def _walk(data, name, include, exclude, put):
+    """
+    Flattening engine, calls put(key, value) for every flat key
+
+    include and exclude are sets, see flatten for their meaning
+    """
+    if not isinstance(data, (dict, list)):
+        if not include:
+            put(name, _text(data))
+        return
+
+    root = (name,) if name else ()
+    # frames of (children left to visit, key path, leaf key prefix, kept)
+    stack = [(_items(data), root, name + "_" if name else "", not include)]
+    push = stack.append
+    join = "_".join
+    while stack:
+        children, path, prefix, kept = stack[-1]
+        for key, x in children:
+            if type(key) is not str:
+                key = str(key)
+            if type(x) is str:
+                if kept or key in include:
+                    put(prefix + key, x)
+                continue
+            if isinstance(x, (dict, list)) and x:
+                if kept and key in exclude:
+                    put(prefix + key, _text(x))
+                    continue
+                child = path + (key,)
+                push((_items(x), child, join(child) + "_",
+                      kept or key in include))
+                break
+            if kept or key in include:
+                put(prefix + key, _text(x))
+        else:
+            stack.pop()
+
 
 def flatten(data, name="", include=[], exclude=[]):
     """
     Flattens single to deeply nested data
 
+    Walks the data with an explicit stack, so nesting depth isn't bound
+    by the recursion limit. Each container's key path is joined once into
+    a prefix for its leaves and only leaves are converted to strings.
+
     Parameters
     ----------
     data : [] or {}
     name : String, optional
-    Use if data does not contain nested data
+    Prefix for every key, use if data is itself a nested value
     include : [str], optional
-    Keys to flatten and return
+    Keys to flatten and return, at any depth; everything else is left out
     exclude : [str], optional
-    Keys to exclude from being flattened
+    Keys to exclude from being flattened, at any depth; their value is
+    returned as one string
     Returns
     -------
     Dict
     """
+    out = {}
+    _walk(data, name, frozenset(include), frozenset(exclude),
+          out.__setitem__)
+    return out
 
-    if name != "":
-        name = + "_"
 
-    out = {}
+def flatten_many(records, name="", include=[], exclude=[],
+                 output='pandas'):
+    """
+    Flattens many records straight into columns
+
+    Every flat value is appended to its column as it is found, no dict is
+    built per record. Columns are the union of the records' keys in order
+    of first appearance, a record without a key gets None in its column.
+
+    Parameters
+    ----------
+    records : iterable of [] or {}
+    name : String, optional
+    Prefix for every key
+    include : [str], optional
+    Keys to flatten and return, as in flatten
+    exclude : [str], optional
+    Keys to exclude from being flattened, as in flatten
+    output : str
+    'pandas' for a DataFrame, 'arrow' for a pyarrow.Table of strings or
+    'columns' for {key: [values]}
+    Returns
+    -------
+    DataFrame or pyarrow.Table or Dict
+    """
+    _check_output(output)
+    include = frozenset(include)
+    exclude = frozenset(exclude)
+    sink = _Columns()
+    put = sink.put
+    for record in records:
+        _walk(record, name, include, exclude, put)
+        sink.end_row()
+    return sink.output(output)
+
+
+def _check_output(output):
+    if output not in OUTPUTS:
+        raise ValueError(f"output must be one of {OUTPUTS}, not {output!r}")
+    if output == 'arrow' and pa is None:
+        raise ImportError("output='arrow' requires pyarrow, "
+                          "use output='pandas' or install pyarrow")
+
 
-    def flatten(x, name=""):
-        if type(x) is dict:
-            for a in x:
-                flatten(x[a], name + a + "_")
-        elif type(x) is list:
-            i = 0
-            for a in x:
-                flatten(a, name + str(i) + "_")
-                i += 1
+class _Columns:
+    """
+    Column buffers filled a flat value or a batch of rows at a time,
+    missing values None
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+        self.written = 0
+
+    def put(self, key, value):
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = [None] * self.rows
+        if len(column) == self.rows:
+            column.append(value)
+            self.written += 1
         else:
-            a = ""
-        try:
-            a = str(x)
-        except Exception:
-            a = x.encode("ascii", "igonore").decode("ascii")
-        out[str(name[:-1])] = a
+            # repeated key within a record, the last value wins as in
+            # flatten
+            column[-1] = value
+
+    def end_row(self):
+        self.rows += 1
+        if self.written != len(self.columns):
+            self._pad()
+        self.written = 0
+
+    def extend(self, names, rows):
+        """
+        Appends rows of values given in the order of names
+        """
+        for key, values in zip(names, zip(*rows)):
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = [None] * self.rows
+            column.extend(values)
+        self.rows += len(rows)
+        if len(names) != len(self.columns):
+            self._pad()
+
+    def _pad(self):
+        for column in self.columns.values():
+            if len(column) < self.rows:
+                column.extend([None] * (self.rows - len(column)))
+
+    def output(self, output):
+        if output == 'columns':
+            return self.columns
+        if output == 'arrow':
+            return pa.table({key: pa.array(column, pa.string())
+                             for key, column in self.columns.items()})
+        return pd.DataFrame(self.columns, index=pd.RangeIndex(self.rows))
+
+
+# leaf types whose str() is their flat value, checked before anything else
+_SCALARS = frozenset((int, float, bool, type(None)))
+
+
+class _Mismatch(Exception):
+    pass
+
+
+def _leaf(x):
+    if isinstance(x, (dict, list)) and x:
+        raise _Mismatch
+    return _text(x)
+
+
+def _shape(x, kept, include, exclude):
+    """
+    Hashable structure of a record as flatten sees it: 'v' for a leaf,
+    'x' for an excluded value, ('d', ((key, shape), ...)) for a dict and
+    ('l', (shape, ...)) for a list
+    """
+    if not (isinstance(x, (dict, list)) and x):
+        return 'v'
+    if type(x) is dict:
+        children = []
+        for key, value in x.items():
+            if type(key) not in (str, int):
+                raise _Mismatch
+            children.append((key, _child_shape(
+                str(key), value, kept, include, exclude)))
+        return ('d', tuple(children))
+    if type(x) is list:
+        return ('l', tuple(_child_shape(str(i), value, kept, include, exclude)
+                           for i, value in enumerate(x)))
+    # subclasses are left to the generic engine
+    raise _Mismatch
+
+
+def _child_shape(key, x, kept, include, exclude):
+    if kept and key in exclude:
+        return 'x'
+    return _shape(x, kept or key in include, include, exclude)
 
-    def flatten_include(x, name="", include=include):
-        out = {}
 
-        if type(x) is dict:
-            for a in x:
-                if str(a) in include:
-                    flatten(x[a], name + a + "_")
-                else:
-                    flatten_include(x[a], name + a + "_", include)
-        elif type(x) is list:
-            i = 0
-            for a in x:
-                if str(a) in include:
-                    flatten(x[a], name + a + "_")
-                else:
-                    flatten_include(a, name + str(i) + "_", include)
-                    i += 1
+def _generate(shape, name, include):
+    """
+    Source of a function returning a record's flat values as a tuple,
+    raising _Mismatch or KeyError for a record of another shape
+
+    Returns
+    -------
+    (names, source) : (tuple of str, str)
+    """
+    lines = []
+    outputs = {}
+    variables = count()
+
+    def guard(var, shape):
+        kind, children = shape
+        container = 'dict' if kind == 'd' else 'list'
+        lines.append(f"if type({var}) is not {container} or len({var}) != "
+                     f"{len(children)}: raise _Mismatch")
+        return iter(children) if kind == 'd' else enumerate(children)
+
+    # frames of (variable, children left, key path prefix, kept), visited
+    # in the order flatten visits them so keys come out in the same order
+    stack = [('r', guard('r', shape), name + "_" if name else "",
+              not include)]
+    while stack:
+        var, children, prefix, kept = stack[-1]
+        for key, child in children:
+            flat_key = str(key)
+            value = f"v{next(variables)}"
+            lines.append(f"{value} = {var}[{key!r}]")
+            leaf = f"{value} if type({value}) is str else "
+            if child == 'x':
+                expression = leaf + f"_text({value})"
+            elif child == 'v':
+                expression = leaf + f"str({value}) if type({value}) in " \
+                    f"_SCALARS else _leaf({value})"
+            else:
+                stack.append((value, guard(value, child),
+                              prefix + flat_key + "_",
+                              kept or flat_key in include))
+                break
+            if kept or flat_key in include:
+                if prefix + flat_key in outputs:
+                    # repeated flat key, the last value wins as in flatten
+                    # and the one it replaces is still checked
+                    lines.append(f"_ = {outputs[prefix + flat_key]}")
+                outputs[prefix + flat_key] = expression
+            else:
+                lines.append(f"if type({value}) is not str and "
+                             f"type({value}) not in _SCALARS: "
+                             f"_leaf({value})")
         else:
-            a = ""
+            stack.pop()
+    names = tuple(outputs)
+    source = "def flat(r):\n" + "".join(
+        f"    {line}\n" for line in lines) + "    return (" + "".join(
+        f"{expression}, " for expression in outputs.values()) + ")\n"
+    return names, source
+
+
+class Flattener:
+    """
+    flatten specialised to one record shape
+
+    Made by compile_flattener. Records of the compiled shape are flattened
+    by generated straight-line code, any other record by flatten, so
+    results are the same as flatten's; keys come in the compiled shape's
+    order.
+
+    Attributes
+    ----------
+    names : tuple of str
+      flat keys of the compiled shape, () if nothing was compiled
+    source : str
+      generated code, None if nothing was compiled
+    fallbacks : int
+      records that didn't match and went through flatten
+    """
+
+    def __init__(self, shape, name, include, exclude):
+        self.name = name
+        self.include = include
+        self.exclude = exclude
+        self.fallbacks = 0
+        self.names = ()
+        self.source = None
+        self._flat = None
+        if shape is not None:
+            self.names, self.source = _generate(shape, name, include)
+            namespace = {'_Mismatch': _Mismatch, '_SCALARS': _SCALARS,
+                         '_leaf': _leaf, '_text': _text}
+            exec(compile(self.source, '<flattener>', 'exec'), namespace)
+            self._flat = namespace['flat']
+
+    def __call__(self, record):
+        """
+        Flattens one record
+
+        Parameters
+        ----------
+        record : [] or {}
+        Returns
+        -------
+        Dict
+        """
+        if self._flat is not None:
             try:
-                a = str(x)
-            except Exception:
-                a = x.encode("ascii", "igonore").decode("ascii")
-        out[str(name[:-1])] = a
-
-    def flatten_exclude(x, name="", exclude=exclude):
-        a = ""
-        if type(x) is dict:
-            for a in x:
-                if str(a) in exclude:
-                    exclude_name = a
-                    try:
-                        a = str(x[a])
-                    except Exception:
-                        a = x[a].encode("ascii", "igonore").decode("ascii")
-                    out[str(name + exclude_name)] = a
-                    continue
-                else:
-                    flatten_exclude(x[a], name + a + "_", exclude)
-        elif type(x) is list:
-            i = 0
-            for a in x:
-                if str(a) in exclude:
-                    exclude_name = a
-                    try:
-                        a = str(x[a])
-                    except Exception:
-                        a = x[a].encode("ascii", "igonore").decode("ascii")
-                    out[str(exclude_name)] = a
+                return dict(zip(self.names, self._flat(record)))
+            except (_Mismatch, KeyError):
+                pass
+        self.fallbacks += 1
+        out = {}
+        _walk(record, self.name, self.include, self.exclude,
+              out.__setitem__)
+        return out
+
+    def many(self, records, output='pandas'):
+        """
+        Flattens many records into columns, as flatten_many
+
+        Parameters
+        ----------
+        records : iterable of [] or {}
+        output : str
+        'pandas' for a DataFrame, 'arrow' for a pyarrow.Table of strings or
+        'columns' for {key: [values]}
+        Returns
+        -------
+        DataFrame or pyarrow.Table or Dict
+        """
+        _check_output(output)
+        sink = _Columns()
+        flat = self._flat
+        rows = []
+        append = rows.append
+        for record in records:
+            if flat is not None:
+                try:
+                    append(flat(record))
                     continue
-                else:
-                    flatten(a, name + str(i) + "_")
-                    i += 1
-        else:
-            a + ""
-            try:
-                a = str(x)
-            except Exception:
-                a = x.encode("ascii", "igonore").decode("ascii")
-            out[str(name[:-1])] = a
-
-    if include:
-        flatten_include(data, name, include)
-    elif exclude:
-        flatten_exclude(data, name, exclude)
-    else:
-        flatten(data, name)
+                except (_Mismatch, KeyError):
+                    pass
+            # rows so far go in first to keep the record order
+            if rows:
+                sink.extend(self.names, rows)
+                rows.clear()
+            self.fallbacks += 1
+            _walk(record, self.name, self.include, self.exclude, sink.put)
+            sink.end_row()
+        if rows:
+            sink.extend(self.names, rows)
+        return sink.output(output)
 
-    return out
+
+def compile_flattener(sample_records, name="", include=[], exclude=[]):
+    """
+    Generates a flattener specialised to the shape of sample records
+
+    The most common shape among the samples, the same keys in the same
+    order and lists of the same length, is compiled into a function of
+    plain key lookups that returns the flat values as a tuple. Use it when
+    records share a fixed shape; any record that differs is flattened by
+    the generic engine.
+
+    Parameters
+    ----------
+    sample_records : iterable of [] or {}
+    Records to infer the shape from
+    name : String, optional
+    Prefix for every key
+    include : [str], optional
+    Keys to flatten and return, as in flatten
+    exclude : [str], optional
+    Keys to exclude from being flattened, as in flatten
+    Returns
+    -------
+    Flattener
+    Callable like flatten, with many() like flatten_many
+    """
+    include = frozenset(include)
+    exclude = frozenset(exclude)
+    counts = {}
+    for record in sample_records:
+        if not (isinstance(record, (dict, list)) and record):
+            continue
+        try:
+            shape = _shape(record, not include, include, exclude)
+        except (_Mismatch, RecursionError):
+            continue
+        counts[shape] = counts.get(shape, 0) + 1
+    shape = max(counts, key=counts.get) if counts else None
+    try:
+        return Flattener(shape, name, include, exclude)
+    except (RecursionError, MemoryError, SyntaxError):
+        # too deep or too wide to compile, flatten handles any shape
+        return Flattener(None, name, include, exclude)
 
 
 def _test():
@@ -136,7 +452,39 @@ def _test():
     for r in data:
         data_flat.append(flatten(r, exclude=['apple', 'cookie']))
 
-    if data_flat == expected:
+    expected_include = [{
+        'apple_type': 'THIS',
+        'apple_serial': '12345',
+        'cookie_0_another_type': 'THAT',
+        'cookie_0_another_serial': '67890'
+    }]
+
+    data_include = [flatten(r, include=['apple', 'cookie']) for r in data]
+
+    expected_name = {'apple_type': 'THIS', 'apple_serial': '12345'}
+
+    deep = {}
+    node = deep
+    for _ in range(5000):
+        node['a'] = {}
+        node = node['a']
+    node['b'] = 1
+
+    if data_flat == expected \
+            and data_include == expected_include \
+            and flatten(data[0]['apple'], name='apple') == expected_name \
+            and flatten(deep) == {'_'.join(['a'] * 5000 + ['b']): '1'} \
+            and flatten_many(data + [{'eclaire': 'Anna', 'fig': 7}],
+                             exclude=['apple', 'cookie'],
+                             output='columns') == {
+                key: [value, 'Anna' if key == 'eclaire' else None]
+                for key, value in expected[0].items()} | {
+                'fig': [None, '7']} \
+            and all(compile_flattener(data, **kwargs)(r)
+                    == flatten(r, **kwargs)
+                    for kwargs in ({}, {'exclude': ['apple', 'cookie']},
+                                   {'include': ['apple', 'cookie']})
+                    for r in data + [{'eclaire': {'nested': 'Anna'}}]):
         return "Success"
 
 
@@ -173,4 +521,16 @@ for r in data:
 data_flat = flatten(data[0]['apple'], name='apple')
 
 >>> {'apple_type': 'THIS', 'apple_serial': '12345'}
+
+df = flatten_many(data, include=['apple', 'cookie'])
+
+>>>   apple_type apple_serial cookie_0_another_type cookie_0_another_serial
+    0       THIS        12345                  THAT                   67890
+
+table = flatten_many(records, exclude=['raw'], output='arrow')
+
+flattener = compile_flattener(records[:100], exclude=['raw'])
+df = flattener.many(records)
+flattener.fallbacks
+>>> 3
 """
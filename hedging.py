@@ -0,0 +1,196 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+from .timing import Histogram
+
+
+class _Latencies:
+    """
+    Running latency histogram of one host over roughly the last `window`
+    requests: a full histogram is swapped out for a fresh one, and
+    answers percentiles until the fresh one has `min_samples`
+    """
+
+    def __init__(self, window, min_samples):
+        self.window = window
+        self.min_samples = min_samples
+        self.current = Histogram()
+        self.previous = None
+
+    def add(self, ns):
+        if self.current.count >= self.window:
+            self.previous, self.current = self.current, Histogram()
+        self.current.add(ns)
+
+    def percentile(self, p):
+        histogram = self.current
+        if histogram.count < self.min_samples:
+            histogram = self.previous
+        if histogram is None:
+            return None
+        return histogram.percentile(p)
+
+
+class HedgePolicy:
+    """
+    Sends a second copy of a request that is still unanswered after the
+    host's running p95 latency, and uses whichever copy answers first
+
+    A few slow replicas behind a host then stop setting the time of a
+    whole pull. Hedges are capped at `budget` of the requests made, so a
+    host that is slow across the board gets at most that much extra load
+    rather than double. Only get requests are hedged unless `posts` is
+    set, a post is repeated only when it is safe to send twice.
+
+    Parameters
+    ----------
+    percentile : float
+      latency percentile, between 0 and 100, after which a copy is sent
+    min_samples : int
+      requests to a host observed before its requests are hedged
+    window : int
+      recent requests the running percentile is taken over
+    budget : float
+      hedges allowed per request made
+    posts : bool
+      hedge post requests too
+    """
+
+    def __init__(self, percentile=95, min_samples=20, window=1000,
+                 budget=0.05, posts=False):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.budget = budget
+        self.posts = posts
+        self.latencies = {}
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+
+    def _latencies(self, host):
+        if host not in self.latencies:
+            self.latencies[host] = _Latencies(self.window, self.min_samples)
+        return self.latencies[host]
+
+    def delay(self, url):
+        """
+        Seconds to wait for an answer before hedging a request to url
+
+        Parameters
+        ----------
+        url : str
+          URL of the request, its host selects the latencies
+        Returns
+        -------
+        seconds : float or None
+          None until the host has min_samples observed requests
+        """
+        ns = self._latencies(urlsplit(url).netloc).percentile(
+            self.percentile)
+        return None if ns is None else ns / 1e9
+
+    def _withdraw(self):
+        if self.hedged >= self.budget * self.requests:
+            return False
+        self.hedged += 1
+        return True
+
+    async def run(self, attempt, url):
+        """
+        Awaits attempt(sent), starting attempt(sent, copy=True) if the
+        first is still running delay(url) after it was sent
+
+        Parameters
+        ----------
+        attempt : callable
+          coroutine function making one try, it calls sent() once the
+          request is on its way, i.e. after any wait for a rate limit or
+          concurrency slot, so that wait isn't taken for latency. The
+          copy should share the first try's concurrency slot rather than
+          queue for one behind the slow requests it is meant to overtake.
+        url : str
+          URL of the request
+        Returns
+        -------
+        result : obj
+          value returned by the first attempt() to succeed, the error of
+          the last one is raised if both fail
+        """
+        latencies = self._latencies(urlsplit(url).netloc)
+        self.requests += 1
+        loop = asyncio.get_running_loop()
+
+        async def timed(sent_at, copy=False):
+
+            def sent():
+                if not sent_at.done():
+                    sent_at.set_result(time.perf_counter_ns())
+
+            result = await attempt(sent, copy=copy) if copy \
+                else await attempt(sent)
+            if sent_at.done():
+                latencies.add(time.perf_counter_ns() - sent_at.result())
+            return result
+
+        first_sent = loop.create_future()
+        first = asyncio.ensure_future(timed(first_sent))
+        tasks = {first}
+        try:
+            await asyncio.wait({first, first_sent},
+                               return_when=asyncio.FIRST_COMPLETED)
+            done, tasks = await asyncio.wait(
+                tasks, timeout=self.delay(url),
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done and self._withdraw():
+                tasks.add(asyncio.ensure_future(
+                    timed(loop.create_future(), copy=True)))
+            while True:
+                # read every exception so none is reported as unretrieved
+                errors = {task: task.exception() for task in done}
+                for task, error in errors.items():
+                    if error is None:
+                        if task is not first:
+                            self.won += 1
+                        return task.result()
+                if not tasks:
+                    raise error
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        """
+        Hedging counters and current hedge delays
+
+        Returns
+        -------
+        stats : dict
+          requests, hedges sent, hedges that answered first and the
+          hedge delay of every host in milliseconds
+        """
+        delays = {}
+        for host, latencies in self.latencies.items():
+            ns = latencies.percentile(self.percentile)
+            delays[host] = None if ns is None else ns / 1e6
+        return {
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'won': self.won,
+            'delays': delays,
+        }
+
+
+"""
+How to use:
+from toolbox.hedging import HedgePolicy
+hedging = HedgePolicy(percentile=95, budget=0.05)
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, timeout=10, deadline=300,
+    hedging=hedging)
+hedging.stats()
+>>> {'requests': 5000, 'hedged': 212, 'won': 180,
+     'delays': {'api.example.com': 84.1}}
+"""
@@ -0,0 +1,387 @@
+import asyncio
+from collections import deque
+from itertools import count
+import math
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+from .data_pull import client_session, fetch
+from .runner import sync_iter
+from .scheduler import AdaptiveScheduler
+
+
+def dig(data, path):
+    """
+    Value at a dotted key path, e.g. 'meta.paging.total'
+
+    Parameters
+    ----------
+    data : dict
+    path : str
+    Returns
+    -------
+    value : obj
+      None if any key along the path is missing
+    """
+    for key in path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def with_params(url, **params):
+    """
+    URL with query parameters added or replaced
+
+    Parameters
+    ----------
+    url : str
+    **params
+      query parameters to set
+    Returns
+    -------
+    url : str
+    """
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    query.update({k: str(v) for k, v in params.items()})
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class Paginator:
+    """
+    Base class describing how an endpoint pages its results
+
+    Parameters
+    ----------
+    url : str
+      URL of the first page, without paging parameters
+    records_key : str, optional
+      dotted path to the list of records in a page, the page itself if None
+
+    Attributes
+    ----------
+    failed : [str]
+      URLs of the pages whose request failed in the last paginate run
+    """
+
+    # chained paginators only learn the next URL from the previous page
+    chained = False
+
+    def __init__(self, url, records_key=None):
+        self.url = url
+        self.records_key = records_key
+        self.failed = []
+
+    def records(self, page):
+        if page is None:
+            return []
+        records = dig(page, self.records_key) if self.records_key else page
+        return records or []
+
+
+class OffsetPaginator(Paginator):
+    """
+    offset/limit paging, e.g. ?offset=200&limit=100
+
+    Parameters
+    ----------
+    url : str
+      URL of the first page, without paging parameters
+    limit : int
+      records per page
+    total_key : str, optional
+      dotted path to the total record count in the first page. Without it
+      pages are requested speculatively until a short page comes back.
+    records_key : str, optional
+      dotted path to the list of records in a page
+    offset_param : str
+      name of the offset query parameter
+    limit_param : str
+      name of the page size query parameter
+    start : int
+      offset of the first record
+    """
+
+    def __init__(self, url, limit=100, total_key=None, records_key=None,
+                 offset_param='offset', limit_param='limit', start=0):
+        super().__init__(url, records_key)
+        self.limit = limit
+        self.total_key = total_key
+        self.offset_param = offset_param
+        self.limit_param = limit_param
+        self.start = start
+
+    def page_url(self, index):
+        return with_params(self.url, **{
+            self.offset_param: self.start + index * self.limit,
+            self.limit_param: self.limit})
+
+    def page_count(self, first_page):
+        total = dig(first_page, self.total_key) if self.total_key else None
+        if total is None:
+            return None
+        return math.ceil((int(total) - self.start) / self.limit)
+
+    def is_last(self, page):
+        return len(self.records(page)) < self.limit
+
+
+class PagePaginator(Paginator):
+    """
+    page-number paging, e.g. ?page=3&per_page=100
+
+    Parameters
+    ----------
+    url : str
+      URL of the first page, without paging parameters
+    size : int, optional
+      records per page, sent as size_param when given
+    total_pages_key : str, optional
+      dotted path to the page count in the first page
+    total_key : str, optional
+      dotted path to the total record count, used with size when there is
+      no page count
+    records_key : str, optional
+      dotted path to the list of records in a page
+    page_param : str
+      name of the page number query parameter
+    size_param : str
+      name of the page size query parameter
+    start : int
+      number of the first page
+    """
+
+    def __init__(self, url, size=None, total_pages_key=None, total_key=None,
+                 records_key=None, page_param='page', size_param='per_page',
+                 start=1):
+        super().__init__(url, records_key)
+        self.size = size
+        self.total_pages_key = total_pages_key
+        self.total_key = total_key
+        self.page_param = page_param
+        self.size_param = size_param
+        self.start = start
+
+    def page_url(self, index):
+        params = {self.page_param: self.start + index}
+        if self.size:
+            params[self.size_param] = self.size
+        return with_params(self.url, **params)
+
+    def page_count(self, first_page):
+        if self.total_pages_key:
+            pages = dig(first_page, self.total_pages_key)
+            if pages is not None:
+                return int(pages)
+        if self.total_key and self.size:
+            total = dig(first_page, self.total_key)
+            if total is not None:
+                return math.ceil(int(total) / self.size)
+        return None
+
+    def is_last(self, page):
+        records = self.records(page)
+        return not records or (self.size is not None
+                               and len(records) < self.size)
+
+
+class CursorPaginator(Paginator):
+    """
+    cursor paging, the next page is requested with a cursor taken from the
+    previous page, e.g. ?cursor=abc123
+
+    Parameters
+    ----------
+    url : str
+      URL of the first page, without paging parameters
+    cursor_key : str
+      dotted path to the next cursor in a page, empty when done
+    records_key : str, optional
+      dotted path to the list of records in a page
+    cursor_param : str
+      name of the cursor query parameter
+    """
+
+    chained = True
+
+    def __init__(self, url, cursor_key='next_cursor', records_key=None,
+                 cursor_param='cursor'):
+        super().__init__(url, records_key)
+        self.cursor_key = cursor_key
+        self.cursor_param = cursor_param
+
+    def next_url(self, page, url):
+        cursor = dig(page, self.cursor_key) if page else None
+        if not cursor:
+            return None
+        return with_params(self.url, **{self.cursor_param: cursor})
+
+
+class NextLinkPaginator(Paginator):
+    """
+    paging by a link to the next page in the body, e.g. {"next": "..."}
+
+    Parameters
+    ----------
+    url : str
+      URL of the first page
+    next_key : str
+      dotted path to the next page's URL, absolute or relative
+    records_key : str, optional
+      dotted path to the list of records in a page
+    """
+
+    chained = True
+
+    def __init__(self, url, next_key='next', records_key=None):
+        super().__init__(url, records_key)
+        self.next_key = next_key
+
+    def next_url(self, page, url):
+        link = dig(page, self.next_key) if page else None
+        return urljoin(url, link) if link else None
+
+
+async def paginate(self, paginator, cert, window=10, records=True,
+                   scheduler=None, **fetch_kwargs):
+    """
+    streams every page of a paginated endpoint in order
+
+    Offset and page-number endpoints fan out up to `window` page requests
+    at once after the first page, bounded by the total when the first
+    page reports one. Cursor and next-link endpoints request the next
+    page as soon as its cursor arrives, while the current page is still
+    being consumed.
+
+    A page whose request fails is listed in paginator.failed. Without a
+    total it also ends the run, since past the last page many endpoints
+    answer with an error, e.g. 404, rather than an empty page; pages
+    requested after it are cancelled.
+
+    Parameters
+    ----------
+    paginator : Paginator
+      OffsetPaginator, PagePaginator, CursorPaginator or NextLinkPaginator
+    cert : str
+      filepath for certificate
+    window : int
+      most pages in flight at once
+    records : bool
+      yield individual records instead of whole pages
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    **fetch_kwargs
+      passed to fetch, e.g. cache, retry_policy, rate_limiter, timer
+    Yields
+    -------
+    record or page : obj
+    """
+    if scheduler is None:
+        scheduler = AdaptiveScheduler(max_concurrency=window)
+
+    paginator.failed = []
+
+    async with client_session(self, cert, scheduler) as session:
+
+        def get(url):
+            return asyncio.ensure_future(fetch(
+                self, url, session, get=True, scheduler=scheduler,
+                **fetch_kwargs))
+
+        async def page_at(url, task):
+            page = await task
+            if page is None:
+                paginator.failed.append(url)
+            return page
+
+        def emit(page):
+            return paginator.records(page) if records else [page]
+
+        if paginator.chained:
+            url = paginator.url
+            task = get(url)
+            try:
+                while task is not None:
+                    page = await page_at(url, task)
+                    next_url = paginator.next_url(page, url)
+                    task = get(next_url) if next_url else None
+                    url = next_url
+                    for item in emit(page):
+                        yield item
+            finally:
+                if task is not None:
+                    task.cancel()
+            return
+
+        url = paginator.page_url(0)
+        first = await page_at(url, get(url))
+        for item in emit(first):
+            yield item
+        total = paginator.page_count(first)
+        if total is None and (first is None or paginator.is_last(first)):
+            return
+        indexes = iter(range(1, total) if total is not None else count(1))
+        pending = deque()
+        try:
+            while True:
+                for index in indexes:
+                    url = paginator.page_url(index)
+                    pending.append((url, get(url)))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    return
+                page = await page_at(*pending.popleft())
+                for item in emit(page):
+                    yield item
+                if total is None and (page is None
+                                      or paginator.is_last(page)):
+                    return
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+
+def iter_pages(self, paginator, cert, window=10, records=True,
+               scheduler=None, **fetch_kwargs):
+    """
+    synchronous generator over paginate for code that can't use async for
+
+    Parameters
+    ----------
+    paginator : Paginator
+      OffsetPaginator, PagePaginator, CursorPaginator or NextLinkPaginator
+    cert : str
+      filepath for certificate
+    window : int
+      most pages in flight at once
+    records : bool
+      yield individual records instead of whole pages
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    **fetch_kwargs
+      passed to fetch, e.g. cache, retry_policy, rate_limiter, timer
+    Yields
+    -------
+    record or page : obj
+    """
+    return sync_iter(paginate(
+        self, paginator, cert, window=window, records=records,
+        scheduler=scheduler, **fetch_kwargs))
+
+
+"""
+How to use:
+from toolbox.pagination import OffsetPaginator, CursorPaginator, iter_pages
+paginator = OffsetPaginator(f"{base}/items", limit=500,
+                            total_key='meta.total', records_key='items')
+rows = [flatten(r) for r in iter_pages(session_module, paginator, cert_path,
+                                       window=20)]
+
+paginator = CursorPaginator(f"{base}/events", cursor_key='next_cursor',
+                            records_key='data')
+for record in iter_pages(session_module, paginator, cert_path):
+    ...
+paginator.failed
+>>> []
+"""
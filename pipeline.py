@@ -0,0 +1,188 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from .data_pull import fetch_many
+from .flatten import flatten, flatten_many
+from .pagination import dig
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+OUTPUTS = ('arrow', 'columns', 'records')
+
+
+class _Credentials:
+    """
+    Stand-in for Session inside worker processes, holds what
+    data_pull.get_client needs
+    """
+
+    def __init__(self, pw, transport):
+        self.pw = pw
+        self.transport = transport
+        self.async_client = None
+
+
+# per worker process: one event loop and one AsyncClient reused by every
+# shard the process runs, so connections stay warm between shards
+_worker = {}
+
+
+def _init_worker(pw, transport):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _worker['loop'] = loop
+    _worker['self'] = _Credentials(pw, transport)
+
+
+def _records(responses, records_key):
+    for response in responses:
+        records = dig(response, records_key) \
+            if records_key and response is not None else response
+        if records is None:
+            continue
+        if isinstance(records, list):
+            yield from records
+        else:
+            yield records
+
+
+def _run_shard(urls, cert, get, post, post_jsons, records_key,
+               flatten_kwargs, output, fetch_kwargs):
+    loop = _worker['loop']
+    responses = loop.run_until_complete(fetch_many(
+        _worker['self'], loop, urls, cert, get=get, post=post,
+        post_jsons=post_jsons, **fetch_kwargs))
+    records = _records(responses, records_key)
+    if output == 'records':
+        return [flatten(record, **flatten_kwargs) for record in records]
+    columns = flatten_many(records, output='columns', **flatten_kwargs)
+    if output == 'arrow':
+        return pa.RecordBatch.from_pydict(columns)
+    return columns
+
+
+def _concat_columns(shards):
+    names = {}
+    for columns in shards:
+        names.update(dict.fromkeys(columns))
+    out = {name: [] for name in names}
+    for columns in shards:
+        length = len(next(iter(columns.values()), ()))
+        for name in names:
+            out[name].extend(columns.get(name) or [None] * length)
+    return out
+
+
+def _concat_batches(batches):
+    names = {}
+    for batch in batches:
+        names.update(dict.fromkeys(batch.schema.names))
+    schema = pa.schema([(name, pa.string()) for name in names])
+    aligned = []
+    for batch in batches:
+        if not batch.num_rows:
+            continue
+        aligned.append(pa.RecordBatch.from_arrays([
+            batch.column(batch.schema.get_field_index(name)).cast(pa.string())
+            if name in batch.schema.names
+            else pa.nulls(batch.num_rows, pa.string())
+            for name in names], schema=schema))
+    return pa.Table.from_batches(aligned, schema=schema)
+
+
+def pipeline_get_all(self, urls, cert, get=False, post=False,
+                     post_jsons=[{}], processes=None, shards_per_process=4,
+                     records_key=None, flatten_kwargs=None, output='arrow',
+                     start_method='spawn', **fetch_kwargs):
+    """
+    fetch, decode and flatten spread over worker processes
+
+    The requests are split into contiguous shards run by `processes`
+    worker processes. Each process has its own event loop and connection
+    pool, and flattens the records it fetched before sending back a
+    compact columnar shard, so decoding and flattening scale with cores
+    instead of sharing the parent's one.
+
+    Parameters
+    ----------
+    urls : [str]
+      List of URLs to get, or the single URL to post to
+    cert : str
+      filepath for certificate
+    get : bool
+      Set to perform get request
+    post : bool
+      Set to perform post request
+    post_jsons : [dict]
+      list of dictionaries to use with post requests
+    processes : int, optional
+      worker processes, os.cpu_count() if None
+    shards_per_process : int
+      shards per process, more shards even out slow hosts at the cost of
+      more round trips to the parent
+    records_key : str, optional
+      dotted path to the list of records in each response, a response
+      that is a list is a list of records, anything else one record
+    flatten_kwargs : dict, optional
+      include, exclude or name passed to flatten.flatten
+    output : str
+      'arrow' for a pyarrow.Table, 'columns' for {key: [values]}, or
+      'records' for a list of flat dicts. Columns are the union of every
+      record's keys, missing values are None.
+    start_method : str
+      multiprocessing start method, 'spawn' avoids forking a process
+      with a running event loop and threads
+    **fetch_kwargs
+      passed to fetch_many in every process, e.g. max_concurrency,
+      coalesce, decoder. They are pickled, so retry policies, rate
+      limiters and timers, which hold locks, can't be shared; each
+      process uses its own defaults.
+    Returns
+    -------
+    result : pyarrow.Table or dict or list
+      rows in request order, failed requests are left out
+    """
+    if output not in OUTPUTS:
+        raise ValueError(f"output must be one of {OUTPUTS}, not {output!r}")
+    if output == 'arrow' and pa is None:
+        raise ImportError("output='arrow' requires pyarrow, "
+                          "use output='columns' or install pyarrow")
+    items = list(urls) if get else list(post_jsons) if post else []
+    if not items:
+        return [] if output == 'records' else {} if output == 'columns' \
+            else pa.table({})
+    processes = processes or os.cpu_count() or 1
+    count = max(1, min(len(items), processes * shards_per_process))
+    size = -(-len(items) // count)
+    shards = [items[i:i + size] for i in range(0, len(items), size)]
+
+    with ProcessPoolExecutor(
+            max_workers=min(processes, len(shards)) or 1,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker, initargs=(
+                self.pw, getattr(self, 'transport', 'aiohttp'))) as pool:
+        futures = [pool.submit(
+            _run_shard, shard if get else urls[:1], cert, get, post,
+            [{}] if get else shard, records_key, flatten_kwargs or {},
+            output, fetch_kwargs) for shard in shards]
+        results = [future.result() for future in futures]
+
+    if output == 'records':
+        return [row for rows in results for row in rows]
+    if output == 'columns':
+        return _concat_columns(results)
+    return _concat_batches(results)
+
+
+"""
+How to use:
+from toolbox.pipeline import pipeline_get_all
+table = pipeline_get_all(session_module, urls, cert_path, get=True,
+                         processes=8, records_key='items',
+                         flatten_kwargs={'exclude': ['raw']})
+df = table.to_pandas()
+"""
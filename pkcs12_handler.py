@@ -1,20 +1,37 @@
 from contextlib import contextmanager
+from hashlib import sha256
+import os
 from pathlib import Path
+import ssl
 from tempfile import NamedTemporaryFile
-from cryoptography.hazmat.primitives.serialization import (
+import threading
+import time
+from cryptography.hazmat.primitives.serialization import (
     Encoding,
     PrivateFormat,
     NoEncryption,
 )
-from cryoptography.hazmat.primitives.serialization.pkcs12 import (
+from cryptography.hazmat.primitives.serialization.pkcs12 import (
     load_key_and_certificates
 )
 
+# decrypted PEM bytes and SSL contexts keyed by path, mtime, size and a
+# hash of the password, so the PKCS#12 key derivation runs once per file
+_pem_cache = {}
+_context_cache = {}
+_cache_lock = threading.Lock()
 
-@contextmanager
-def pfx_to_pem(pfx_path, pfx_password):
+
+def _cache_key(pfx_path, pfx_password):
+    path = os.path.abspath(pfx_path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size,
+            sha256(pfx_password.encode("utf-8")).digest())
+
+
+def load_pem(pfx_path, pfx_password):
     """
-    Decrypts the .pfx file to be used with requests
+    Decrypts the .pfx file into PEM bytes, cached in memory
 
     Parameters
     ----------
@@ -25,28 +42,220 @@ def pfx_to_pem(pfx_path, pfx_password):
 
     Returns
     -------
-    None
+    pem : bytes
+      unencrypted private key followed by the certificate chain
     """
+    key = _cache_key(pfx_path, pfx_password)
+    with _cache_lock:
+        pem = _pem_cache.get(key)
+    if pem is not None:
+        return pem
+
     pfx = Path(pfx_path).read_bytes()
     private_key, main_cert, add_certs = load_key_and_certificates(
         pfx, pfx_password.encode("utf-8"), None
     )
+    pem = b"".join(
+        [private_key.private_bytes(
+            Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()),
+         main_cert.public_bytes(Encoding.PEM)]
+        + [ca.public_bytes(Encoding.PEM) for ca in add_certs or []]
+    )
+    with _cache_lock:
+        # drop entries for older versions of the same file
+        for stale in [k for k in _pem_cache if k[0] == key[0]]:
+            del _pem_cache[stale]
+        _pem_cache[key] = pem
+    return pem
 
-    with NamedTemporaryFile(suffix=".pem") as t_pem:
-        with open(t_pem.name, "wb") as pem_file:
-            pem_file.write(
-                private_key.private_bytes(
-                    Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()
-                )
-            )
-            pem_file.write(main_cert.public_bytes(Encoding.PEM))
-            for ca in add_certs:
-                pem_file.write(ca.public_bytes(Encoding.PEM))
+
+@contextmanager
+def _pem_file(pem):
+    """
+    Exposes PEM bytes as a file path, backed by an anonymous in-memory
+    file where the OS supports it so the key never touches disk
+    """
+    if hasattr(os, "memfd_create"):
+        fd = os.memfd_create("pkcs12-pem", os.MFD_CLOEXEC)
+        try:
+            os.write(fd, pem)
+            yield f"/proc/self/fd/{fd}"
+        finally:
+            os.close(fd)
+    else:
+        with NamedTemporaryFile(suffix=".pem") as t_pem:
+            with open(t_pem.name, "wb") as pem_file:
+                pem_file.write(pem)
             yield t_pem.name
 
 
+@contextmanager
+def pfx_to_pem(pfx_path, pfx_password):
+    """
+    Decrypts the .pfx file to be used with requests
+
+    Parameters
+    ----------
+    pfx_path : str
+      filepath of certificate
+    pfx_password : str
+      password to unlock file
+
+    Returns
+    -------
+    None
+    """
+    with _pem_file(load_pem(pfx_path, pfx_password)) as pem_path:
+        yield pem_path
+
+
+class TLSSessionCache:
+    """
+    Latest resumable TLS session per server, offered on new connections
+    so they resume instead of running a full handshake with the client
+    certificate
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.handshakes = 0
+        self.resumed = 0
+        self._lock = threading.Lock()
+
+    def get(self, server_hostname):
+        with self._lock:
+            session = self.sessions.get(server_hostname)
+            if session is not None \
+                    and time.time() >= session.time + session.timeout:
+                del self.sessions[server_hostname]
+                session = None
+        return session
+
+    def save(self, server_hostname, session):
+        with self._lock:
+            self.sessions[server_hostname] = session
+
+    def handshake(self, resumed):
+        with self._lock:
+            self.handshakes += 1
+            self.resumed += resumed
+
+    def stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+          handshakes, how many resumed a session and the servers with a
+          session to offer
+        """
+        with self._lock:
+            return {"handshakes": self.handshakes, "resumed": self.resumed,
+                    "servers": len(self.sessions)}
+
+
+class _ResumingSSLObject(ssl.SSLObject):
+    """
+    SSLObject for asyncio and anyio connections that offers the context's
+    cached session for the server and caches the session it gets back.
+    TLS 1.3 tickets arrive after the handshake, so reads keep looking
+    for one until it is saved.
+    """
+
+    @classmethod
+    def _create(cls, incoming, outgoing, server_side=False,
+                server_hostname=None, session=None, context=None):
+        cache = context.session_cache
+        if session is None and not server_side and server_hostname:
+            session = cache.get(server_hostname)
+        sslobj = super()._create(incoming, outgoing, server_side,
+                                 server_hostname, session, context)
+        sslobj._ticket_saved = server_side or not server_hostname
+        return sslobj
+
+    def do_handshake(self):
+        super().do_handshake()
+        self.context.session_cache.handshake(self.session_reused)
+        self._save_ticket()
+
+    def read(self, len=1024, buffer=None):
+        data = super().read(len, buffer)
+        if not self._ticket_saved:
+            self._save_ticket()
+        return data
+
+    def _save_ticket(self):
+        session = self.session
+        if session is not None and session.has_ticket:
+            self.context.session_cache.save(self.server_hostname, session)
+            self._ticket_saved = True
+
+
+def ssl_context(pfx_path, pfx_password, cafile=None, alpn=None,
+                resume=False):
+    """
+    SSLContext loaded with the .pfx key and certificate chain, cached so
+    repeat calls return the same context
+
+    Parameters
+    ----------
+    pfx_path : str
+      filepath of certificate
+    pfx_password : str
+      password to unlock file
+    cafile : str, optional
+      CA bundle to verify servers against, system default if None
+    alpn : (str), optional
+      protocols to offer during the handshake, e.g. ('h2', 'http/1.1').
+      Contexts with different protocols are cached separately.
+    resume : bool
+      resume TLS sessions on new connections to a server the context
+      already connected to, for connections made through asyncio (aiohttp,
+      httpx). sslcontext.session_cache.stats() counts resumptions.
+
+    Returns
+    -------
+    sslcontext : ssl.SSLContext
+    """
+    key = _cache_key(pfx_path, pfx_password) + (cafile, alpn, resume)
+    with _cache_lock:
+        sslcontext = _context_cache.get(key)
+    if sslcontext is not None:
+        return sslcontext
+
+    sslcontext = ssl.create_default_context(cafile=cafile)
+    with pfx_to_pem(pfx_path, pfx_password) as pem_path:
+        sslcontext.load_cert_chain(certfile=pem_path)
+    if alpn:
+        sslcontext.set_alpn_protocols(list(alpn))
+    if resume:
+        sslcontext.session_cache = TLSSessionCache()
+        sslcontext.sslobject_class = _ResumingSSLObject
+    with _cache_lock:
+        for stale in [k for k in _context_cache
+                      if k[0] == key[0] and k[1:4] != key[1:4]]:
+            del _context_cache[stale]
+        _context_cache[key] = sslcontext
+    return sslcontext
+
+
+def clear_cache():
+    """
+    Forgets all decrypted key material and SSL contexts
+    """
+    with _cache_lock:
+        _pem_cache.clear()
+        _context_cache.clear()
+
+
 """
 How to use:
 with pfx_to_pem('foo.p12', 'foo_password') as cert:
   resp = requests.post(url, cert=cert, data=payload)
+
+sslcontext = ssl_context('foo.p12', 'foo_password', cafile=certifi.where())
+
+# new connections resume the TLS session instead of a full handshake
+sslcontext = ssl_context('foo.p12', 'foo_password', resume=True)
+sslcontext.session_cache.stats()
+>>> {'handshakes': 100, 'resumed': 99, 'servers': 1}
 """
@@ -0,0 +1,148 @@
+import asyncio
+from fnmatch import fnmatchcase
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at `rate` tokens per second up to `burst`
+
+    Tokens are reserved ahead of time, so callers are spaced exactly
+    1/rate apart once the burst is spent instead of polling for tokens.
+
+    Parameters
+    ----------
+    rate : float
+      requests allowed per second
+    burst : int
+      requests allowed back to back after an idle period
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, possibly from the future
+
+        Returns
+        -------
+        delay : float
+          seconds to wait before the request may be sent
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Per-host and per-endpoint request rate limits shared by the async and
+    sync request paths
+
+    Rules are matched in order against "host/path" when the pattern
+    contains a "/", otherwise against the host alone, using shell-style
+    wildcards. The first matching rule wins, and every host gets its own
+    bucket for that rule.
+
+    Parameters
+    ----------
+    rules : dict or [tuple], optional
+      {pattern: rate} or [(pattern, rate, burst)] in priority order
+    default_rate : float, optional
+      requests per second for hosts no rule matches, unlimited if None
+    burst : int
+      burst size for rules that don't give one
+    """
+
+    def __init__(self, rules=None, default_rate=None, burst=1):
+        if isinstance(rules, dict):
+            rules = list(rules.items())
+        self.rules = [(rule[0], rule[1], rule[2] if len(rule) > 2 else burst)
+                      for rule in rules or []]
+        self.default_rate = default_rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, url):
+        """
+        Bucket governing url, None if it isn't limited
+
+        Parameters
+        ----------
+        url : str
+          URL of the request
+        Returns
+        -------
+        bucket : TokenBucket
+        """
+        parts = urlsplit(url)
+        host = parts.netloc
+        endpoint = host + parts.path
+        for pattern, rate, burst in self.rules:
+            if fnmatchcase(endpoint if "/" in pattern else host, pattern):
+                key = (pattern, host)
+                break
+        else:
+            if self.default_rate is None:
+                return None
+            key, rate, burst = (None, host), self.default_rate, self.burst
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(rate, burst)
+            return self._buckets[key]
+
+    async def acquire(self, url):
+        """
+        Waits until a request to url is allowed
+
+        Parameters
+        ----------
+        url : str
+          URL of the request
+        """
+        bucket = self.bucket(url)
+        if bucket is not None:
+            delay = bucket.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+
+    def acquire_sync(self, url):
+        """
+        Blocking counterpart of acquire() for synchronous code and threads
+
+        Parameters
+        ----------
+        url : str
+          URL of the request
+        """
+        bucket = self.bucket(url)
+        if bucket is not None:
+            delay = bucket.reserve()
+            if delay:
+                time.sleep(delay)
+
+
+"""
+How to use:
+from toolbox.rate_limiter import RateLimiter
+limiter = RateLimiter({'api.example.com/v1/search*': 2,
+                       '*.example.com': 20},
+                      default_rate=50)
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, rate_limiter=limiter)
+data_pull.sync_requests_get_all(urls, session, rate_limiter=limiter)
+"""
@@ -0,0 +1,471 @@
+import asyncio
+import atexit
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from hashlib import sha256
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+class CacheEntry:
+    """
+    Cached GET response
+
+    Parameters
+    ----------
+    url : str
+      URL the response was fetched from
+    body : bytes
+      raw response body
+    expires : float
+      epoch seconds after which the entry must be revalidated
+    etag : str
+      ETag validator sent back as If-None-Match
+    last_modified : str
+      Last-Modified validator sent back as If-Modified-Since
+    value : obj, optional
+      decoded JSON body, decoded from body on first use if None
+    decoder : callable, optional
+      bytes -> object used to decode body, json.loads if None
+    """
+
+    def __init__(self, url, body, expires, etag=None, last_modified=None,
+                 value=None, decoder=None):
+        self.url = url
+        self.body = body
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self._value = value
+        self._decoder = decoder or json.loads
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = self._decoder(self.body)
+        return self._value
+
+    @property
+    def fresh(self):
+        return time.time() < self.expires
+
+    @property
+    def reusable(self):
+        # stale entries without validators can't be revalidated
+        return self.fresh or bool(self.etag or self.last_modified)
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    def conditional_headers(self):
+        """
+        Validators for a conditional GET
+
+        Returns
+        -------
+        headers : dict
+          If-None-Match / If-Modified-Since headers, empty if the server
+          sent no validators
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+def _cache_control(headers):
+    directives = {}
+    for part in headers.get("Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+    return directives
+
+
+class ResponseCache:
+    """
+    Two tier cache of GET responses: an in-memory LRU of decoded JSON in
+    front of an optional on-disk SQLite store of raw bodies
+
+    Freshness follows Cache-Control max-age/no-cache/no-store and Expires,
+    falling back to `ttl`. Stale entries with an ETag or Last-Modified are
+    revalidated with a conditional GET, so a 304 reuses the cached body
+    without transferring or decoding it again.
+
+    Writes to the disk tier are queued to a writer thread that applies
+    them in batches, one commit per batch, so storing a response never
+    waits on SQLite. alookup() reads the disk tier on a worker thread.
+    flush() waits for queued writes and close() stops the writer.
+
+    Parameters
+    ----------
+    directory : str, optional
+      folder for the on-disk tier, memory only if None
+    ttl : float
+      seconds a response is fresh when the server doesn't say
+    max_entries : int
+      most responses kept in memory
+    max_bytes : int
+      most body bytes kept in memory
+    max_disk_bytes : int
+      most body bytes kept on disk
+    decoder : callable, optional
+      bytes -> object for bodies read back from disk, json.loads if None.
+      Use the same decoder the requests are made with.
+    """
+
+    def __init__(self, directory=None, ttl=300, max_entries=1024,
+                 max_bytes=256 * 2**20, max_disk_bytes=2**30, decoder=None):
+        self.ttl = ttl
+        self.decoder = decoder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._disk_bytes = 0
+        self._writes = None
+        self._writer = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(directory, "responses.sqlite"),
+                check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT, body BLOB, expires REAL, "
+                "etag TEXT, last_modified TEXT, size INTEGER, "
+                "accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires "
+                             "ON responses (expires)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed "
+                             "ON responses (accessed)")
+            self._db.commit()
+            # kept up to date by the writer instead of summed per store
+            self._disk_bytes, = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+            self._writes = queue.SimpleQueue()
+            self._writer = threading.Thread(
+                target=self._write_loop, name="response-cache-writer",
+                daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    @staticmethod
+    def _key(url):
+        return sha256(url.encode("utf-8")).hexdigest()
+
+    def get(self, url):
+        """
+        Cached entry for url, fresh or stale, or None
+
+        Parameters
+        ----------
+        url : str
+          URL of the GET request
+        Returns
+        -------
+        entry : CacheEntry
+        """
+        with self._lock:
+            entry = self._memory.get(url)
+            if entry is not None:
+                if entry.reusable:
+                    self._memory.move_to_end(url)
+                    return entry
+                del self._memory[url]
+                self._memory_bytes -= entry.size
+        if self._db is None:
+            return None
+        key = self._key(url)
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT body, expires, etag, last_modified FROM responses "
+                "WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        entry = CacheEntry(url, row[0], row[1], row[2], row[3],
+                           decoder=self.decoder)
+        if not entry.reusable:
+            self._writes.put(("delete", key))
+            return None
+        self._writes.put(("touch", key, time.time()))
+        with self._lock:
+            self._remember(entry)
+        return entry
+
+    def lookup(self, url):
+        """
+        Cached entry for url, counting a hit when it is fresh and a miss
+        otherwise
+
+        Parameters
+        ----------
+        url : str
+          URL of the GET request
+        Returns
+        -------
+        (entry, fresh) : tuple
+          entry is None on a cold miss; when not fresh its validators
+          belong on the request
+        """
+        entry = self.get(url)
+        if entry is not None and entry.fresh:
+            self.hits += 1
+            return entry, True
+        self.misses += 1
+        return entry, False
+
+    async def alookup(self, url):
+        """
+        lookup() for coroutines, a disk tier read runs on a worker thread
+        so it doesn't block the event loop
+
+        Parameters
+        ----------
+        url : str
+          URL of the GET request
+        Returns
+        -------
+        (entry, fresh) : tuple
+        """
+        if self._db is None or url in self._memory:
+            return self.lookup(url)
+        return await asyncio.to_thread(self.lookup, url)
+
+    def _expires(self, headers):
+        directives = _cache_control(headers)
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives:
+            return time.time()
+        if directives.get("max-age", "").isdigit():
+            return time.time() + int(directives["max-age"])
+        if headers.get("Expires"):
+            try:
+                return parsedate_to_datetime(headers["Expires"]).timestamp()
+            except (TypeError, ValueError):
+                return time.time()
+        return time.time() + self.ttl
+
+    def store(self, url, headers, body, value=None):
+        """
+        Caches a 200 response unless it is marked no-store
+
+        Parameters
+        ----------
+        url : str
+          URL of the GET request
+        headers : mapping
+          response headers
+        body : bytes
+          raw response body
+        value : obj, optional
+          already decoded JSON body
+        """
+        expires = self._expires(headers)
+        if expires is None:
+            return
+        entry = CacheEntry(url, body, expires, headers.get("ETag"),
+                           headers.get("Last-Modified"), value, self.decoder)
+        with self._lock:
+            self._remember(entry)
+        self._persist(entry)
+
+    def revalidate(self, entry, headers):
+        """
+        Refreshes a stale entry after a 304 Not Modified
+
+        Parameters
+        ----------
+        entry : CacheEntry
+          entry whose validators were sent
+        headers : mapping
+          headers of the 304 response
+        Returns
+        -------
+        value : obj
+          cached JSON body
+        """
+        self.revalidated += 1
+        expires = self._expires(headers)
+        entry.expires = time.time() if expires is None else expires
+        entry.etag = headers.get("ETag", entry.etag)
+        entry.last_modified = headers.get(
+            "Last-Modified", entry.last_modified)
+        with self._lock:
+            self._remember(entry)
+        self._persist(entry)
+        return entry.value
+
+    def _remember(self, entry):
+        old = self._memory.pop(entry.url, None)
+        if old is not None:
+            self._memory_bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self._memory[entry.url] = entry
+        self._memory_bytes += entry.size
+        while (len(self._memory) > self.max_entries
+               or self._memory_bytes > self.max_bytes):
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.size
+
+    def _persist(self, entry):
+        if self._db is None:
+            return
+        self._writes.put(("store", (
+            self._key(entry.url), entry.url, entry.body, entry.expires,
+            entry.etag, entry.last_modified, entry.size, time.time())))
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            # whatever queued up while the last batch was written goes
+            # in one transaction
+            batch = [self._writes.get()]
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            flushed = []
+            with self._db_lock:
+                try:
+                    for write in batch:
+                        if write is None:
+                            stop = True
+                        elif isinstance(write, threading.Event):
+                            flushed.append(write)
+                        else:
+                            self._write(*write)
+                    self._evict()
+                    self._db.commit()
+                except sqlite3.Error:
+                    # the disk tier is best effort, drop the batch
+                    self._db.rollback()
+                    self._disk_bytes, = self._db.execute(
+                        "SELECT COALESCE(SUM(size), 0) FROM responses"
+                    ).fetchone()
+            for event in flushed:
+                event.set()
+
+    def _write(self, kind, *args):
+        if kind == "clear":
+            self._db.execute("DELETE FROM responses")
+            self._disk_bytes = 0
+            return
+        key = args[0]
+        if kind == "touch":
+            self._db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?",
+                (args[1], key))
+            return
+        if kind == "store":
+            key = args[0][0]
+        row = self._db.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._disk_bytes -= row[0]
+        if kind == "store":
+            self._db.execute(
+                "REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                args[0])
+            self._disk_bytes += args[0][6]
+        elif row is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _evict(self):
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        # stale entries without validators can never be reused, then the
+        # least recently used until back under budget
+        for query, args in (
+                ("SELECT key, size FROM responses WHERE expires < ? "
+                 "AND etag IS NULL AND last_modified IS NULL",
+                 (time.time(),)),
+                ("SELECT key, size FROM responses ORDER BY accessed", ())):
+            evicted = []
+            for key, size in self._db.execute(query, args):
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+                evicted.append((key,))
+                self._disk_bytes -= size
+            self._db.executemany(
+                "DELETE FROM responses WHERE key = ?", evicted)
+
+    def flush(self):
+        """
+        Waits until every queued disk write is committed
+        """
+        if self._writer is None or not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._writes.put(done)
+        done.wait()
+
+    def stats(self):
+        """
+        Hit/miss counters
+
+        Returns
+        -------
+        stats : dict
+          hits, misses, 304 revalidations and entries held in memory
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_bytes": self._disk_bytes,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self._db is not None:
+            self._writes.put(("clear",))
+            self.flush()
+
+    def close(self):
+        """
+        Commits queued disk writes and stops the writer thread
+        """
+        if self._writer is None:
+            return
+        atexit.unregister(self.close)
+        if self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join()
+        self._writer = None
+        self._db.close()
+
+
+"""
+How to use:
+from toolbox.response_cache import ResponseCache
+cache = ResponseCache(directory=os.path.expanduser('~/.cache/toolbox'),
+                      ttl=600)
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, cache=cache)
+data_pull.cache_stats
+>>> {'hits': 950, 'misses': 50, 'revalidated': 48, ...}
+cache.close()  # commits queued disk writes
+"""
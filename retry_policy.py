@@ -0,0 +1,334 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class HTTPStatusError(Exception):
+    """
+    Raised for a response whose status code isn't OK
+
+    Parameters
+    ----------
+    status : int
+      HTTP status code
+    url : str
+      URL of the request
+    retry_after : str, optional
+      value of the Retry-After response header
+    """
+
+    def __init__(self, status, url, retry_after=None):
+        super().__init__(f"{status} from {url}")
+        self.status = status
+        self.url = url
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request to a host whose circuit is open
+    """
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header
+
+    Parameters
+    ----------
+    value : str
+      delay in seconds or an HTTP date
+    Returns
+    -------
+    seconds : float or None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a host after `threshold` consecutive failures, then
+    lets a single probe through once `reset_timeout` seconds have passed
+
+    Parameters
+    ----------
+    threshold : int
+      consecutive failures that open the circuit
+    reset_timeout : float
+      seconds the circuit stays open before a probe is allowed
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def check(self, host=""):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._probing):
+                raise CircuitOpenError(
+                    f"circuit open for {host}, failing fast")
+            if state == "half-open":
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self):
+        # a probe ended without telling us anything about the host
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class RetryBudget:
+    """
+    Caps retries across all requests to `min_retries` plus `ratio` of the
+    requests made, so a failing backend isn't hit with a retry storm
+
+    Parameters
+    ----------
+    ratio : float
+      retries allowed per request made
+    min_retries : int
+      retries always allowed regardless of request volume
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.requests += 1
+
+    def withdraw(self):
+        with self._lock:
+            if self.retries >= self.min_retries + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Retries failed requests with exponential backoff and full jitter,
+    honoring Retry-After, within a per-request attempt limit, a global
+    RetryBudget and a CircuitBreaker per host
+
+    Parameters
+    ----------
+    attempts : int
+      most tries per request, including the first
+    backoff : float
+      base delay in seconds, doubled on every retry
+    max_backoff : float
+      longest delay between tries
+    retry_statuses : tuple of int
+      status codes worth retrying
+    retry_on : tuple of Exception
+      exception types worth retrying when they carry no status code
+    budget : RetryBudget, optional
+      shared cap on retries, a new RetryBudget() if None
+    breaker_threshold : int
+      consecutive failures that open a host's circuit
+    breaker_timeout : float
+      seconds a host's circuit stays open
+    """
+
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30,
+                 retry_statuses=(408, 429, 500, 502, 503, 504),
+                 retry_on=(OSError, asyncio.TimeoutError), budget=None,
+                 breaker_threshold=5, breaker_timeout=30):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = retry_statuses
+        self.retry_on = tuple(retry_on) + (HTTPStatusError,)
+        self.budget = budget or RetryBudget()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.breakers = {}
+
+    def breaker(self, host):
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(
+                self.breaker_threshold, self.breaker_timeout)
+        return self.breakers[host]
+
+    def retryable(self, error):
+        response = getattr(error, "response", None)
+        status = getattr(error, "status", None) or getattr(
+            response, "status_code", None)
+        if status is not None:
+            return status in self.retry_statuses
+        return isinstance(error, self.retry_on)
+
+    def delay(self, attempt, error=None):
+        """
+        Seconds to wait before retry number `attempt` (0 based)
+
+        Parameters
+        ----------
+        attempt : int
+          retries already made
+        error : Exception, optional
+          failure being retried, its Retry-After is honored
+        Returns
+        -------
+        seconds : float
+        """
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is None:
+            headers = getattr(getattr(error, "response", None),
+                              "headers", None) or {}
+            retry_after = headers.get("Retry-After")
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _failed(self, error, attempt, breaker):
+        # True when the error should be retried
+        if not self.retryable(error):
+            # the host answered, it just wasn't a retryable answer
+            breaker.record_success()
+            return False
+        breaker.record_failure()
+        return attempt + 1 < self.attempts and self.budget.withdraw()
+
+    async def run(self, attempt, url):
+        """
+        Awaits attempt() until it succeeds or retries run out
+
+        Parameters
+        ----------
+        attempt : callable
+          no-argument coroutine function making one try
+        url : str
+          URL of the request, its host selects the circuit breaker
+        Returns
+        -------
+        result : obj
+          value returned by attempt()
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+        self.budget.deposit()
+        for n in range(self.attempts):
+            breaker.check(host)
+            try:
+                result = await attempt()
+            except self.retry_on as error:
+                if not self._failed(error, n, breaker):
+                    raise
+                wait = self.delay(n, error)
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            await asyncio.sleep(wait)
+
+    def call(self, attempt, url):
+        """
+        Blocking counterpart of run() for synchronous code and threads
+
+        Parameters
+        ----------
+        attempt : callable
+          no-argument function making one try
+        url : str
+          URL of the request, its host selects the circuit breaker
+        Returns
+        -------
+        result : obj
+          value returned by attempt()
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+        self.budget.deposit()
+        for n in range(self.attempts):
+            breaker.check(host)
+            try:
+                result = attempt()
+            except self.retry_on as error:
+                if not self._failed(error, n, breaker):
+                    raise
+                wait = self.delay(n, error)
+            except BaseException:
+                breaker.release()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            time.sleep(wait)
+
+    def stats(self):
+        """
+        Retry and circuit breaker state
+
+        Returns
+        -------
+        stats : dict
+          requests, retries and the circuit state of every host
+        """
+        return {
+            "requests": self.budget.requests,
+            "retries": self.budget.retries,
+            "circuits": {host: breaker.state
+                         for host, breaker in self.breakers.items()},
+        }
+
+
+"""
+How to use:
+from toolbox.retry_policy import RetryPolicy
+policy = RetryPolicy(attempts=8, backoff=0.25, breaker_threshold=10)
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, retry_policy=policy)
+policy.stats()
+>>> {'requests': 5000, 'retries': 12,
+     'circuits': {'api.example.com': 'closed'}}
+
+# any blocking call
+result = policy.call(lambda: session.get(url).json(), url)
+"""
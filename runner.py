@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+# loop per thread for sync callers outside any event loop, kept between
+# calls so pooled connections stay open
+_local = threading.local()
+# loop on a background thread for sync callers already inside a running
+# loop (Jupyter), which can't be blocked or re-entered
+_background = None
+_lock = threading.Lock()
+
+
+def use_uvloop():
+    """
+    Opt in to uvloop for scripts and services, call it before the first
+    request so the loops toolbox creates are uvloop loops
+
+    Returns
+    -------
+    installed : bool
+      False if uvloop isn't installed
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def _own_loop():
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop
+
+
+def _background_loop():
+    global _background
+    with _lock:
+        if _background is None or _background.is_closed():
+            _background = asyncio.new_event_loop()
+            threading.Thread(target=_background.run_forever,
+                             name='toolbox-event-loop', daemon=True).start()
+        return _background
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine to completion from synchronous code
+
+    Outside an event loop the coroutine runs on this thread's own loop.
+    Inside a running loop, e.g. a Jupyter cell, it runs on a loop on a
+    background thread while the caller waits, so the running loop is
+    neither blocked from the inside nor patched. Code that is already
+    async should await the coroutine instead.
+
+    Parameters
+    ----------
+    coro : coroutine
+    Returns
+    -------
+    result : obj
+      what the coroutine returns
+    """
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        return _own_loop().run_until_complete(coro)
+    if running is _background:
+        coro.close()
+        raise RuntimeError("run_sync can't wait on the loop it runs on, "
+                           "await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, _background_loop()).result()
+
+
+async def _anext(agen):
+    return await agen.__anext__()
+
+
+async def _aclose(agen):
+    await agen.aclose()
+
+
+def sync_iter(agen):
+    """
+    drives an async generator from synchronous code through run_sync
+
+    Parameters
+    ----------
+    agen : async generator
+    Yields
+    -------
+    item : obj
+      whatever agen yields
+    """
+    try:
+        while True:
+            try:
+                yield run_sync(_anext(agen))
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(_aclose(agen))
+
+
+"""
+How to use:
+from toolbox.runner import run_sync, use_uvloop
+use_uvloop()  # optional, scripts and services
+resp, timings = run_sync(data_pull.get_all(session_module, urls, cert_path,
+                                           get=True))
+"""
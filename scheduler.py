@@ -0,0 +1,216 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+
+class AIMDLimit:
+    """
+    Additive-increase/multiplicative-decrease concurrency limit
+
+    Grows by roughly one slot per round trip while latency stays near the
+    best observed latency, and is cut by `backoff` when latency climbs past
+    `latency_tolerance` times that baseline or a request fails.
+
+    Parameters
+    ----------
+    initial : int
+      starting number of concurrent requests
+    minimum : int
+      floor the limit never drops below
+    maximum : int
+      ceiling the limit never grows past
+    backoff : float
+      factor the limit is multiplied by on congestion
+    latency_tolerance : float
+      ratio of smoothed latency to baseline latency treated as congestion
+    smoothing : float
+      weight of the newest sample in the smoothed latency
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=100, backoff=0.5,
+                 latency_tolerance=2.0, smoothing=0.2):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.baseline = None
+        self.latency = None
+        self._cooldown_until = 0.0
+
+    def __int__(self):
+        return int(self.limit)
+
+    def on_success(self, latency):
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # let the baseline follow a sustained shift in server latency
+            self.baseline += (latency - self.baseline) * self.smoothing / 10
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * self.smoothing
+
+        if self.latency > self.baseline * self.latency_tolerance:
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_failure(self):
+        self._decrease()
+
+    def _decrease(self):
+        # cut at most once per round trip so a burst of errors from one
+        # window of requests doesn't collapse the limit to the floor
+        now = time.perf_counter()
+        if now < self._cooldown_until:
+            return
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        self._cooldown_until = now + (self.latency or 0)
+
+
+class _Slot:
+    """
+    Handle yielded by AdaptiveScheduler.slot(), set status to report the
+    HTTP status code of the request made inside the slot
+    """
+
+    def __init__(self):
+        self.status = None
+        self.failed = False
+
+
+class AdaptiveScheduler:
+    """
+    Bounds concurrent requests globally and per host, adjusting both limits
+    with AIMD based on observed latency and 5xx/429/timeout rates
+
+    Parameters
+    ----------
+    max_concurrency : int
+      most requests in flight across all hosts
+    max_per_host : int
+      most requests in flight to a single host, 0 for max_concurrency
+    initial_concurrency : int
+      limit to start at before any feedback has been observed
+    min_concurrency : int
+      limit never drops below this
+    backoff : float
+      factor limits are multiplied by on congestion
+    latency_tolerance : float
+      ratio of smoothed latency to baseline latency treated as congestion
+    """
+
+    def __init__(self, max_concurrency=100, max_per_host=0,
+                 initial_concurrency=10, min_concurrency=1, backoff=0.5,
+                 latency_tolerance=2.0):
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host or max_concurrency
+        self._limit_kwargs = dict(
+            initial=initial_concurrency, minimum=min_concurrency,
+            backoff=backoff, latency_tolerance=latency_tolerance)
+        self.limit = AIMDLimit(maximum=max_concurrency, **self._limit_kwargs)
+        self.host_limits = {}
+        self._in_flight = 0
+        self._host_in_flight = {}
+        self._waiters = []
+
+    def _host_limit(self, host):
+        if host not in self.host_limits:
+            self.host_limits[host] = AIMDLimit(
+                maximum=self.max_per_host, **self._limit_kwargs)
+        return self.host_limits[host]
+
+    def _has_room(self, host, host_limit):
+        return (self._in_flight < int(self.limit)
+                and self._host_in_flight.get(host, 0) < int(host_limit))
+
+    def _wake(self):
+        # every waiter rechecks its own host budget, so wake them all
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, url, shared=False):
+        """
+        Waits for a free global and per-host slot and holds it for the
+        duration of the block
+
+        Parameters
+        ----------
+        url : str
+          URL the request is made to, its host selects the per-host limit
+        shared : bool
+          the block runs alongside a request that already holds a slot,
+          e.g. a hedged copy, so it neither waits nor counts against the
+          limits
+        Returns
+        -------
+        slot : obj
+          set slot.status to the response status code
+        """
+        if shared:
+            yield _Slot()
+            return
+        host = urlsplit(url).netloc
+        host_limit = self._host_limit(host)
+        while not self._has_room(host, host_limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self._in_flight += 1
+        self._host_in_flight[host] = self._host_in_flight.get(host, 0) + 1
+
+        slot = _Slot()
+        start = time.perf_counter()
+        try:
+            yield slot
+        except (asyncio.TimeoutError, OSError):
+            slot.failed = True
+            raise
+        finally:
+            if slot.status is not None and (
+                    slot.status >= 500 or slot.status == 429):
+                slot.failed = True
+            if slot.failed:
+                self.limit.on_failure()
+                host_limit.on_failure()
+            else:
+                latency = time.perf_counter() - start
+                self.limit.on_success(latency)
+                host_limit.on_success(latency)
+            self._in_flight -= 1
+            self._host_in_flight[host] -= 1
+            self._wake()
+
+    def stats(self):
+        """
+        Current limits
+
+        Returns
+        -------
+        stats : dict
+          global limit, requests in flight and per-host limits
+        """
+        return {
+            'limit': int(self.limit),
+            'in_flight': self._in_flight,
+            'hosts': {host: int(limit)
+                      for host, limit in self.host_limits.items()},
+        }
+
+
+"""
+How to use:
+from toolbox.scheduler import AdaptiveScheduler
+scheduler = AdaptiveScheduler(max_concurrency=200, max_per_host=50)
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, scheduler=scheduler)
+scheduler.stats()
+>>> {'limit': 64, 'in_flight': 0, 'hosts': {'api.example.com': 50}}
+"""
@@ -5,7 +5,6 @@ import ipython_blocking
 from IPython.display import display
 import ipywidgets as widgets
 import os
-import nest_asyncio
 import psutil
 import requests
 import sys
@@ -13,18 +12,23 @@ import time
 from requests_pkcs12 import Pkcs12Adapter
 import pdb
 
-nest_asyncio.apply()
-
 # %% Session
 
 
 class Session:
-    def __init__(self, baseURL, certPath="", pw=""):
+    def __init__(self, baseURL, certPath="", pw="", pool_size=10,
+                 transport="aiohttp"):
         """
         Parameters
         ----------
         baseURL : str
           base url to make a singe session object with
+        pool_size : int
+          connections kept per host, match the number of threads sharing
+          the session (data_pull.sync_requests_get_all workers)
+        transport : str
+          client for async requests, 'aiohttp' or 'http2' to multiplex
+          requests over a few HTTP/2 connections (needs httpx[http2])
         Returns
         -------
         None
@@ -33,6 +37,9 @@ class Session:
         self.pw = pw
         self.certFound = False
         self.loop_ran = False
+        self.transport = transport
+        # data_pull transport, created on the first async request
+        self.async_client = None
 
         if certPath:
             if os.path.isfile(certPath):
@@ -74,7 +81,8 @@ class Session:
                     self.pw = getpass()
 
                 cert = Pkcs12Adapter(
-                    pkcs12_filename=self.cert_path, pkcs12_password=self.pw)
+                    pkcs12_filename=self.cert_path, pkcs12_password=self.pw,
+                    pool_connections=pool_size, pool_maxsize=pool_size)
                 self.session = requests.Session()
                 self.session.mount(baseURL, cert)
                 return self.session
@@ -130,6 +138,14 @@ class Session:
                     upload = widgets.FileUpload(accept='*.*', multiple=False)
                     display(upload)
 
+                    # the widget wait has to run nested on the notebook's
+                    # own loop so the kernel keeps delivering its events;
+                    # run_sync would block the kernel thread instead. Note
+                    # nest_asyncio.apply() patches asyncio for the rest of
+                    # the process, not just this upload, so it is only
+                    # imported and applied on this path
+                    import nest_asyncio
+                    nest_asyncio.apply()
                     loop = asyncio.get_event_loop()
                     loop.run_until_complete(
                         wait_click(loop=loop, upload=upload))
@@ -1,6 +1,5 @@
 import asyncio
 from getpass import getpass
-import nest_asyncio
 # from office365.runtime.auth.authentication_context import AuthenticationContext
 from office365.runtime.auth.user_credential import UserCredential
 from office365.sharepoint.client_context import ClientContext
@@ -8,10 +7,10 @@ from office365.sharepoint.files.file import File
 import sys
 import time
 import traceback
+from .retry_policy import RetryPolicy
+from .runner import run_sync
 import pdb
 
-nest_asyncio.apply()
-
 # %% varying imports
 if getattr(sys, 'frozen', False):
     # If the application is run as a bundle, the PyInstaller bootloader
@@ -56,6 +55,9 @@ class SharePoint:
         gui : class optional
             gui class containing a progress bar scaled from 0-1
             and uses .set(<flaot>)
+        retry_policy : RetryPolicy, optional
+            Backoff and circuit breaking for SharePoint queries.
+            The default is RetryPolicy().
         Returns
         -------
         None
@@ -67,6 +69,7 @@ class SharePoint:
         self._folder_url_shpt = kwargs.get('folder_url_shpt', None)
         self.file_ext = kwargs.get('file_ext', None)
         progress_bar = kwargs.get('progress_bar', None)
+        self._retry_policy = kwargs.get('retry_policy') or RetryPolicy()
         self._files_bytes = []
         self._files_count = 0
         self._loop_ran = False
@@ -118,15 +121,18 @@ class SharePoint:
             self.enum_folder(folder, fn)
 
     def _task_coro(self, file):
+        # blocking, _main runs it on a worker thread with asyncio.to_thread
         if not self._use_gui_progressBar:
             self._progressBar.update(1)
         else:
             self._progressBar.set(self._files_count/self._progressBar.total)
         self._files_count += 1
         data = file.to_json()
-        file_bytes = file.read()
+        file_bytes = self._retry_policy.call(file.read, self._url_shpt)
         data.update({'data': file_bytes})
-        properties = file.listItemAllFields.get().execute_query().to_json()
+        properties = self._retry_policy.call(
+            lambda: file.listItemAllFields.get().execute_query(),
+            self._url_shpt).to_json()
         data.update({'listItemAllFields': properties})
         return data
 
@@ -146,7 +152,12 @@ class SharePoint:
         """
         root_folder = self._ctx.web.get_folder_by_server_relative_path(
             self._folder_url_shpt)
-        files = root_folder.get_files(recursive).execute_query()
+        # execute_query and the policy's backoff sleeps block, so they run
+        # on a worker thread instead of stalling the event loop
+        files = await asyncio.to_thread(
+            self._retry_policy.call,
+            lambda: root_folder.get_files(recursive).execute_query(),
+            self._url_shpt)
         # files also contains web assetts. So we must filter files to PDFs only
         files = [x for x in files if x.name.endswith(file_ext)]
         print(f'\nFound {len(files)} {file_ext} files in '
@@ -158,7 +169,29 @@ class SharePoint:
 
     def get_files(self, file_ext='pdf', recursive=False, **kwargs):
         """
-        Gets all SharePoint files ending with specific extension
+        Gets all SharePoint files ending with specific extension, starts an
+        event loop only when none is running. Await get_files_async
+        instead from async code.
+        Parameters
+        ----------
+        file_ext : str
+            file extension to search for
+        recursive : bool, optional
+            Search sub-folders recursively. The default is False.
+
+        Returns
+        -------
+        list
+            List of files in bytes
+
+        """
+        return run_sync(self.get_files_async(file_ext, recursive, **kwargs))
+
+    async def get_files_async(self, file_ext='pdf', recursive=False,
+                              **kwargs):
+        """
+        Awaitable get_files for code already inside an event loop, e.g. a
+        Jupyter cell
         Parameters
         ----------
         file_ext : str
@@ -183,7 +216,7 @@ class SharePoint:
             file_ext = self.file_ext
         start = time.time()
         try:
-            asyncio.run(self._main(file_ext=file_ext))
+            await self._main(file_ext=file_ext)
             if not self._use_gui_progressBar:
                 self._progressBar  # sets progressBar to 100% in case its delayed
                 self._progressBar.close()
@@ -0,0 +1,412 @@
+import codecs
+import json
+import mmap
+import os
+import re
+import time
+from .data_pull import client_session, default_retry_policy, loads
+from .runner import sync_iter
+from .retry_policy import CircuitOpenError, HTTPStatusError
+from .scheduler import AdaptiveScheduler
+
+FORMATS = ('array', 'ndjson')
+_whitespace = re.compile(r'[ \t\n\r]*')
+_delimiters = frozenset(', \t\n\r]')
+
+
+class RecordParser:
+    """
+    Incremental parser turning chunks of a response body into records
+
+    Only the record being parsed and the unread rest of the last chunk are
+    buffered, so memory stays proportional to one record rather than the
+    whole body.
+
+    Parameters
+    ----------
+    format : str
+      'array' for a top-level JSON array, 'ndjson' for one JSON value per
+      line
+    decoder : callable, optional
+      bytes -> object for ndjson lines, defaults to orjson/msgspec/json
+      whichever is installed
+    """
+
+    def __init__(self, format='array', decoder=None):
+        if format not in FORMATS:
+            raise ValueError(f"format must be one of {FORMATS}, "
+                             f"not {format!r}")
+        self.format = format
+        self.decoder = decoder or loads
+        self._parts = []
+        self._text = ''
+        # unparsed characters needed before trying a partial record again
+        self._wait = 0
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._started = False
+        self._comma = False
+        self._done = False
+
+    def feed(self, chunk, final=False):
+        """
+        Parses the next chunk of the body
+
+        Parameters
+        ----------
+        chunk : bytes
+        final : bool
+          chunk is the end of the body
+        Returns
+        -------
+        records : list
+          records completed by this chunk
+        """
+        if self.format == 'ndjson':
+            return self._lines(chunk, final)
+        return self._array(chunk, final)
+
+    def close(self):
+        """
+        Records left at the end of the body
+
+        Returns
+        -------
+        records : list
+        """
+        return self.feed(b'', final=True)
+
+    def _lines(self, chunk, final):
+        chunk = bytes(chunk)
+        if b'\n' not in chunk and not final:
+            self._parts.append(chunk)
+            return []
+        lines = (b''.join(self._parts) + chunk).split(b'\n')
+        self._parts = [] if final else [lines.pop()]
+        return [self.decoder(line) for line in lines if line.strip()]
+
+    def _array(self, chunk, final):
+        text = self._text + self._utf8.decode(bytes(chunk), final)
+        records = []
+        pos = 0
+        while True:
+            pos = _whitespace.match(text, pos).end()
+            if pos == len(text):
+                break
+            if self._done:
+                raise ValueError("data after the end of the JSON array")
+            if not self._started:
+                if text[pos] != '[':
+                    raise ValueError("body is not a JSON array")
+                self._started = True
+                pos += 1
+                continue
+            if text[pos] == ']':
+                self._done = True
+                pos += 1
+                continue
+            if self._comma:
+                if text[pos] != ',':
+                    raise ValueError(f"expected ',' at {text[pos:pos + 20]!r}")
+                self._comma = False
+                pos += 1
+                continue
+            # retrying a long record on every chunk would be quadratic,
+            # wait until the unparsed text has doubled
+            if len(text) - pos < self._wait and not final:
+                break
+            try:
+                record, end = self._json.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                self._wait = 2 * (len(text) - pos)
+                break
+            # a number or literal cut off by the end of the chunk decodes
+            # as its prefix ('1' of '1.5'), only accept one followed by a
+            # delimiter
+            if not final and (end == len(text)
+                              or text[end] not in _delimiters):
+                break
+            records.append(record)
+            self._wait = 0
+            self._comma = True
+            pos = end
+        self._text = text[pos:]
+        if final and not self._done:
+            raise ValueError("JSON array ended early")
+        return records
+
+
+def read_records(path, format='array', chunk_size=2**20, decoder=None):
+    """
+    Records from a downloaded body, read through a memory map so only the
+    pages being parsed are resident
+
+    Parameters
+    ----------
+    path : str
+      file written by download()
+    format : str
+      'array' or 'ndjson'
+    chunk_size : int
+      bytes parsed at a time
+    decoder : callable, optional
+      bytes -> object for ndjson lines
+    Yields
+    -------
+    record : obj
+    """
+    parser = RecordParser(format, decoder)
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield from parser.close()
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for start in range(0, len(view), chunk_size):
+                yield from parser.feed(view[start:start + chunk_size])
+    yield from parser.close()
+
+
+def _request(session, url, post_json, timer, compression=None):
+    if compression is not None:
+        # read undecoded, _chunks decompresses and counts wire bytes
+        if post_json is not None:
+            data, headers = compression.body(post_json)
+            return session.post(
+                url, timeout=None, trace_request_ctx=timer, data=data,
+                headers=compression.headers(headers), auto_decompress=False)
+        return session.get(url, timeout=None, trace_request_ctx=timer,
+                           headers=compression.headers(),
+                           auto_decompress=False)
+    if post_json is not None:
+        return session.post(url, timeout=None, trace_request_ctx=timer,
+                            json=post_json)
+    return session.get(url, timeout=None, trace_request_ctx=timer)
+
+
+def _chunks(response, chunk_size, compression=None):
+    if compression is not None:
+        return compression.iter_decoded(response, chunk_size)
+    return response.content.iter_chunked(chunk_size)
+
+
+async def download(self, url, cert, path, post_json=None, chunk_size=2**16,
+                   scheduler=None, retry_policy=None, rate_limiter=None,
+                   timer=None, compression=None):
+    """
+    Streams a response body straight to a file without holding it in
+    memory, retrying the whole download on failure
+
+    The body is written to path + '.part' and renamed when complete, so
+    path only ever holds a whole body.
+
+    Parameters
+    ----------
+    url : str
+      URL to download
+    cert : str
+      filepath for certificate
+    path : str
+      file to write the body to
+    post_json : dict, optional
+      post this body instead of making a get request
+    chunk_size : int
+      bytes read from the socket at a time
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    retry_policy : RetryPolicy, optional
+      data_pull.default_retry_policy if None
+    rate_limiter : RateLimiter, optional
+      Paces every try to the host's or endpoint's allowed rate
+    timer : RequestTimer, optional
+      Records the phases of every try
+    compression : Compression, optional
+      negotiates the response encoding, the file holds the decoded body
+    Returns
+    -------
+    path : str
+      path, None if the download failed
+    """
+    if scheduler is None:
+        scheduler = AdaptiveScheduler()
+    policy = retry_policy or default_retry_policy
+    part = path + '.part'
+
+    async with client_session(self, cert, scheduler) as session:
+
+        async def attempt():
+            if rate_limiter is not None:
+                await rate_limiter.acquire(url)
+            async with scheduler.slot(url) as slot:
+                start = time.perf_counter_ns()
+                async with _request(session, url, post_json, timer,
+                                    compression) as response:
+                    slot.status = response.status
+                    if not response.ok:
+                        raise HTTPStatusError(
+                            response.status, url,
+                            response.headers.get('Retry-After'))
+                    received = time.perf_counter_ns()
+                    with open(part, 'wb') as file:
+                        async for chunk in _chunks(response, chunk_size,
+                                                   compression):
+                            file.write(chunk)
+            os.replace(part, path)
+            if timer is not None:
+                done = time.perf_counter_ns()
+                timer.record_url(url, 'transfer', done - received)
+                timer.record_url(url, 'total', done - start)
+            return path
+
+        try:
+            return await policy.run(attempt, url)
+        except (CircuitOpenError,) + policy.retry_on as error:
+            print(f"\nRequest to {url} failed: {error!r}")
+            return None
+        finally:
+            if os.path.exists(part):
+                os.remove(part)
+
+
+async def stream_records(self, url, cert, format='array', post_json=None,
+                         chunk_size=2**16, decoder=None, scheduler=None,
+                         rate_limiter=None, timer=None, compression=None):
+    """
+    Records parsed from a response body as it arrives
+
+    Records are yielded before the body has finished downloading, so a
+    failure part way through can't be retried transparently. Use
+    download() and read_records() when the pull has to be retried.
+
+    Parameters
+    ----------
+    url : str
+      URL to request
+    cert : str
+      filepath for certificate
+    format : str
+      'array' for a top-level JSON array, 'ndjson' for one JSON value per
+      line
+    post_json : dict, optional
+      post this body instead of making a get request
+    chunk_size : int
+      bytes read from the socket at a time
+    decoder : callable, optional
+      bytes -> object for ndjson lines
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    rate_limiter : RateLimiter, optional
+      Paces the request to the host's or endpoint's allowed rate
+    timer : RequestTimer, optional
+      Records the phases of the request
+    compression : Compression, optional
+      negotiates the response encoding, decompressed as it arrives
+    Yields
+    -------
+    record : obj
+    """
+    if scheduler is None:
+        scheduler = AdaptiveScheduler()
+    parser = RecordParser(format, decoder)
+
+    async with client_session(self, cert, scheduler) as session:
+        if rate_limiter is not None:
+            await rate_limiter.acquire(url)
+        async with scheduler.slot(url) as slot:
+            start = time.perf_counter_ns()
+            async with _request(session, url, post_json, timer,
+                                compression) as response:
+                slot.status = response.status
+                if not response.ok:
+                    raise HTTPStatusError(
+                        response.status, url,
+                        response.headers.get('Retry-After'))
+                async for chunk in _chunks(response, chunk_size,
+                                           compression):
+                    for record in parser.feed(chunk):
+                        yield record
+            for record in parser.close():
+                yield record
+            if timer is not None:
+                timer.record_url(url, 'total', time.perf_counter_ns() - start)
+
+
+def iter_records(self, url, cert, format='array', post_json=None,
+                 chunk_size=2**16, decoder=None, scheduler=None,
+                 rate_limiter=None, timer=None, compression=None):
+    """
+    synchronous generator over stream_records for code that can't use
+    async for
+
+    Parameters
+    ----------
+    url : str
+      URL to request
+    cert : str
+      filepath for certificate
+    format : str
+      'array' or 'ndjson'
+    post_json : dict, optional
+      post this body instead of making a get request
+    chunk_size : int
+      bytes read from the socket at a time
+    decoder : callable, optional
+      bytes -> object for ndjson lines
+    scheduler : AdaptiveScheduler, optional
+      reuse a scheduler so learned limits carry over between calls
+    rate_limiter : RateLimiter, optional
+      Paces the request to the host's or endpoint's allowed rate
+    timer : RequestTimer, optional
+      Records the phases of the request
+    compression : Compression, optional
+      negotiates the response encoding, decompressed as it arrives
+    Yields
+    -------
+    record : obj
+    """
+    return sync_iter(stream_records(
+        self, url, cert, format=format, post_json=post_json,
+        chunk_size=chunk_size, decoder=decoder, scheduler=scheduler,
+        rate_limiter=rate_limiter, timer=timer, compression=compression))
+
+
+def _test():
+    records = [1.5, -2e10, 3, 'four', None, True, {'six': [6.25, 'x']},
+               [], 12345678901234567890, 'caf\u00e9']
+    bodies = {
+        'array': json.dumps(records).encode('utf-8'),
+        'ndjson': b'\n'.join(json.dumps(r).encode('utf-8')
+                             for r in records) + b'\n',
+    }
+    decoder = json.loads
+    for format, body in bodies.items():
+        # every split point, including inside numbers and multibyte text
+        for offset in range(len(body) + 1):
+            parser = RecordParser(format, decoder)
+            parsed = parser.feed(body[:offset]) + parser.feed(body[offset:])
+            parsed += parser.close()
+            if parsed != records:
+                return f"{format} split at {offset}: {parsed!r}"
+        parser = RecordParser(format, decoder)
+        parsed = [record for i in range(len(body))
+                  for record in parser.feed(body[i:i + 1])]
+        if parsed + parser.close() != records:
+            return f"{format} fed a byte at a time: {parsed!r}"
+    return "Success"
+
+
+"""
+How to use:
+from toolbox.runner import run_sync
+from toolbox.streaming import iter_records, download, read_records
+for record in iter_records(session_module, export_url, cert_path,
+                           format='ndjson'):
+    rows.append(flatten(record))
+
+# retried as a whole, then parsed from disk
+path = run_sync(download(session_module, export_url, cert_path,
+                         '/data/export.json'))
+for record in read_records(path, format='array'):
+    ...
+"""
@@ -0,0 +1,198 @@
+import math
+import threading
+import time
+from urllib.parse import urlsplit
+import aiohttp
+
+# phases in the order a request goes through them. connect covers the TCP
+# connect and TLS handshake together, aiohttp doesn't signal them apart.
+PHASES = ('queued', 'dns', 'connect', 'ttfb', 'transfer', 'decode',
+          'total')
+
+
+class Histogram:
+    """
+    Log-bucketed latency histogram with constant memory per order of
+    magnitude, percentiles are accurate to within `precision`
+
+    Parameters
+    ----------
+    precision : float
+      relative width of a bucket
+    """
+
+    def __init__(self, precision=0.02):
+        self._base = math.log1p(precision)
+        self.buckets = {}
+        self.count = 0
+        self.sum_ns = 0
+        self.max_ns = 0
+
+    def add(self, ns):
+        ns = max(1, int(ns))
+        bucket = int(math.log(ns) / self._base)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum_ns += ns
+        self.max_ns = max(self.max_ns, ns)
+
+    def percentile(self, p):
+        """
+        Parameters
+        ----------
+        p : float
+          percentile between 0 and 100
+        Returns
+        -------
+        ns : float
+          upper edge of the bucket holding the p-th percentile
+        """
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(math.exp((bucket + 1) * self._base), self.max_ns)
+        return self.max_ns
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary : dict
+          count and mean/p50/p95/p99/max in milliseconds
+        """
+        ms = 1e-6
+        return {
+            'count': self.count,
+            'mean': self.sum_ns / self.count * ms if self.count else None,
+            'p50': self.percentile(50) * ms if self.count else None,
+            'p95': self.percentile(95) * ms if self.count else None,
+            'p99': self.percentile(99) * ms if self.count else None,
+            'max': self.max_ns * ms,
+        }
+
+
+class RequestTimer:
+    """
+    Collects per-request phase timings into per-host histograms
+
+    Pass it to fetch as `timer` (async_aiohttp_get_all does this for you)
+    and read the aggregate with summary().
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.started = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def record(self, host, phase, ns):
+        with self._lock:
+            phases = self.hosts.setdefault(host, {})
+            if phase not in phases:
+                phases[phase] = Histogram()
+            phases[phase].add(ns)
+
+    def record_url(self, url, phase, ns):
+        self.record(urlsplit(url).netloc, phase, ns)
+
+    def summary(self):
+        """
+        Returns
+        -------
+        summary : dict
+          wall seconds since the timer was created and, per host and
+          phase, count and mean/p50/p95/p99/max in milliseconds
+        """
+        with self._lock:
+            return {
+                'seconds': (time.perf_counter_ns() - self.started) / 1e9,
+                'hosts': {
+                    host: {phase: phases[phase].summary()
+                           for phase in PHASES if phase in phases}
+                    for host, phases in self.hosts.items()
+                },
+            }
+
+
+def _record(ctx, phase, start):
+    timer = ctx.trace_request_ctx
+    if timer is not None and start is not None:
+        timer.record(ctx.host, phase, time.perf_counter_ns() - start)
+
+
+async def _on_request_start(session, ctx, params):
+    ctx.host = urlsplit(str(params.url)).netloc
+    ctx.start = time.perf_counter_ns()
+    ctx.sent = None
+    ctx.dns_ns = 0
+
+
+async def _on_connection_queued_start(session, ctx, params):
+    ctx.queued = time.perf_counter_ns()
+
+
+async def _on_connection_queued_end(session, ctx, params):
+    _record(ctx, 'queued', ctx.queued)
+
+
+async def _on_dns_resolvehost_start(session, ctx, params):
+    ctx.dns = time.perf_counter_ns()
+
+
+async def _on_dns_resolvehost_end(session, ctx, params):
+    ctx.dns_ns = time.perf_counter_ns() - ctx.dns
+    _record(ctx, 'dns', ctx.dns)
+
+
+async def _on_connection_create_start(session, ctx, params):
+    ctx.connect = time.perf_counter_ns()
+
+
+async def _on_connection_create_end(session, ctx, params):
+    # dns is resolved inside connection creation, count it only once
+    _record(ctx, 'connect', ctx.connect + ctx.dns_ns)
+
+
+async def _on_request_headers_sent(session, ctx, params):
+    ctx.sent = time.perf_counter_ns()
+
+
+async def _on_request_end(session, ctx, params):
+    # fires once the response headers arrive, before the body is read
+    _record(ctx, 'ttfb', ctx.sent or ctx.start)
+
+
+def trace_config():
+    """
+    aiohttp TraceConfig recording queued/dns/connect/ttfb phases into the
+    RequestTimer passed as each request's trace_request_ctx
+
+    Returns
+    -------
+    trace_config : aiohttp.TraceConfig
+    """
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(_on_request_start)
+    config.on_connection_queued_start.append(_on_connection_queued_start)
+    config.on_connection_queued_end.append(_on_connection_queued_end)
+    config.on_dns_resolvehost_start.append(_on_dns_resolvehost_start)
+    config.on_dns_resolvehost_end.append(_on_dns_resolvehost_end)
+    config.on_connection_create_start.append(_on_connection_create_start)
+    config.on_connection_create_end.append(_on_connection_create_end)
+    if hasattr(config, 'on_request_headers_sent'):
+        config.on_request_headers_sent.append(_on_request_headers_sent)
+    config.on_request_end.append(_on_request_end)
+    return config
+
+
+"""
+How to use:
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True)
+timings['hosts']['api.example.com']['ttfb']
+>>> {'count': 5000, 'mean': 41.2, 'p50': 38.9, 'p95': 71.0, 'p99': 120.4,
+     'max': 311.7}
+"""
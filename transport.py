@@ -0,0 +1,371 @@
+import asyncio
+from contextlib import asynccontextmanager
+import time
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+import certifi
+from .pkcs12_handler import ssl_context
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# retire() tasks still running
+_retiring = set()
+
+
+class Transport:
+    """
+    Base for the long-lived clients data_pull.fetch sends requests through
+
+    session() returns an object with the request interface of
+    aiohttp.ClientSession that fetch uses: get(url, **kwargs) and
+    post(url, json=..., **kwargs) return async context managers yielding a
+    response with status, ok, headers, read() and content.iter_chunked().
+
+    Parameters
+    ----------
+    cert : str
+      filepath for certificate
+    pw : str
+      password to unlock the certificate
+    cafile : str, optional
+      CA bundle servers are verified against, certifi's if None
+    """
+
+    # protocols offered in the TLS handshake, None for the default
+    alpn = None
+
+    def __init__(self, cert, pw, cafile=None):
+        self.cert = cert
+        self.pw = pw
+        self.cafile = cafile
+        self._sslcontext = None
+        self._session = None
+        self._loop = None
+        # blocks using each session, see use()
+        self._users = {}
+
+    @property
+    def sslcontext(self):
+        if self._sslcontext is None:
+            self._sslcontext = ssl_context(
+                self.cert, self.pw, cafile=self.cafile or certifi.where(),
+                alpn=self.alpn, resume=True)
+        return self._sslcontext
+
+    def tls_stats(self):
+        """
+        Returns
+        -------
+        stats : dict
+          TLS handshakes made and how many resumed a session
+        """
+        return self.sslcontext.session_cache.stats()
+
+    async def session(self, limit=100):
+        raise NotImplementedError
+
+    @asynccontextmanager
+    async def use(self, limit=100):
+        """
+        session() held for the length of a block
+
+        A call on the same client that needs a new session, e.g. a larger
+        pool or another event loop, doesn't close this one while the block
+        runs; it is closed when the last block using it ends.
+
+        Parameters
+        ----------
+        limit : int
+          passed to session()
+        Yields
+        -------
+        session : obj
+        """
+        session = await self.session(limit)
+        self._users[session] = self._users.get(session, 0) + 1
+        try:
+            yield session
+        finally:
+            self._users[session] -= 1
+            if not self._users[session]:
+                del self._users[session]
+                if session is not self._session and not session.closed:
+                    await session.close()
+
+    async def _retire(self, loop):
+        """
+        Lets go of the current session before a new one is made, closing
+        it unless a use() block still holds it. A session made on another
+        loop is closed on that loop, one whose loop is closed went with it.
+        """
+        session, session_loop = self._session, self._loop
+        self._session = None
+        if session is None or session.closed or session in self._users:
+            return
+        if session_loop is loop:
+            await session.close()
+        elif session_loop is not None and not session_loop.is_closed():
+            asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+
+    def retire(self):
+        """
+        Lets go of this client once it has been replaced, from sync code.
+        Its session is closed on the loop it was made on, or when the
+        last use() block holding it ends.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = self._loop
+            if loop is None or loop.is_closed():
+                return
+            if loop.is_running():
+                # run_sync's background loop
+                asyncio.run_coroutine_threadsafe(self._retire(loop), loop)
+            else:
+                # a thread's own loop, idle between run_sync calls
+                loop.run_until_complete(self._retire(loop))
+            return
+        task = loop.create_task(self._retire(loop))
+        # the loop only keeps a weak reference to its tasks
+        _retiring.add(task)
+        task.add_done_callback(_retiring.discard)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class DNSCache(AbstractResolver):
+    """
+    aiohttp resolver caching addresses for `ttl` seconds, kept by the
+    client so the cache outlives the connectors and event loops it
+    serves. Concurrent lookups of the same host share one query.
+
+    Parameters
+    ----------
+    ttl : float
+      seconds an answer is reused
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._answers = {}
+        self._pending = {}
+        self._resolver = None
+        self._loop = None
+
+    async def resolve(self, host, port=0, family=0):
+        key = (host, port, family)
+        answer = self._answers.get(key)
+        if answer is not None and answer[0] > time.monotonic():
+            return answer[1]
+        pending = self._pending.get(key)
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            if self._resolver is None or self._loop is not loop:
+                self._resolver = DefaultResolver()
+                self._loop = loop
+            pending = self._pending[key] = asyncio.ensure_future(
+                self._resolver.resolve(host, port, family))
+            pending.add_done_callback(
+                lambda _: self._pending.pop(key, None))
+        hosts = await asyncio.shield(pending)
+        self._answers[key] = (time.monotonic() + self.ttl, hosts)
+        return hosts
+
+    async def close(self):
+        # the answers are kept for the next connector
+        if self._resolver is not None:
+            await self._resolver.close()
+        self._resolver = None
+
+
+def _translate(error):
+    # fetch, the scheduler and RetryPolicy classify failures by the
+    # exceptions aiohttp raises
+    if isinstance(error, httpx.TimeoutException):
+        return asyncio.TimeoutError(str(error))
+    if isinstance(error, httpx.DecodingError):
+        # a body that doesn't match its Content-Encoding
+        return aiohttp.ClientPayloadError(f"{type(error).__name__}: {error}")
+    return ConnectionError(f"{type(error).__name__}: {error}")
+
+
+class _Content:
+
+    def __init__(self, response, decompress=True):
+        self._response = response
+        self._decompress = decompress
+
+    async def iter_chunked(self, n):
+        chunks = self._response.aiter_bytes(n) if self._decompress \
+            else self._response.aiter_raw(n)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except (httpx.TransportError, httpx.DecodingError) as error:
+            raise _translate(error) from error
+
+
+class _Response:
+    """
+    httpx response with the attributes fetch reads from aiohttp's
+    """
+
+    def __init__(self, response, decompress=True):
+        self._response = response
+        self._decompress = decompress
+        self.status = response.status_code
+        self.ok = response.status_code < 400
+        self.headers = response.headers
+        self.http_version = response.http_version
+        self.content = _Content(response, decompress)
+
+    async def read(self):
+        if not self._decompress:
+            return b''.join([chunk async for chunk in
+                             self.content.iter_chunked(2**16)])
+        try:
+            return await self._response.aread()
+        except (httpx.TransportError, httpx.DecodingError) as error:
+            raise _translate(error) from error
+
+
+class _Request:
+
+    def __init__(self, client, method, url, timeout=None,
+                 trace_request_ctx=None, headers=None, json=None, data=None,
+                 auto_decompress=True):
+        self._stream = client.stream(
+            method, url, headers=headers, json=json, content=data,
+            timeout=timeout)
+        self._url = url
+        self._timer = trace_request_ctx
+        self._decompress = auto_decompress
+
+    async def __aenter__(self):
+        start = time.perf_counter_ns()
+        try:
+            response = await self._stream.__aenter__()
+        except httpx.TransportError as error:
+            raise _translate(error) from error
+        if self._timer is not None:
+            self._timer.record_url(
+                self._url, 'ttfb', time.perf_counter_ns() - start)
+        return _Response(response, self._decompress)
+
+    async def __aexit__(self, *exc):
+        return await self._stream.__aexit__(*exc)
+
+
+class _HTTP2Session:
+    """
+    aiohttp.ClientSession-like front for an httpx.AsyncClient
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    @property
+    def closed(self):
+        return self._client.is_closed
+
+    def get(self, url, **kwargs):
+        return _Request(self._client, 'GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return _Request(self._client, 'POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        return _Request(self._client, method, url, **kwargs)
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class HTTP2Client(Transport):
+    """
+    HTTP/2 client for a PKI certificate built on httpx and h2
+
+    Requests to a host are multiplexed as streams over a few connections
+    instead of one TCP and mutual-TLS handshake per request in flight, a
+    new connection is only opened when the server's stream limit is
+    reached. Servers that don't offer h2 are spoken to over HTTP/1.1.
+
+    A connection the server drops, e.g. after its per-connection request
+    limit, fails every stream in flight on it together. Give the
+    RetryPolicy a breaker_threshold above the server's stream limit
+    (commonly 100) so that doesn't open the circuit for the host.
+
+    Parameters
+    ----------
+    cert : str
+      filepath for certificate
+    pw : str
+      password to unlock the certificate
+    connections : int
+      most connections per pool, HTTP/2 rarely needs more than a few per
+      host
+    keepalive_timeout : float
+      seconds an idle connection is kept open
+    cafile : str, optional
+      CA bundle servers are verified against, certifi's if None
+    """
+
+    alpn = ('h2', 'http/1.1')
+
+    def __init__(self, cert, pw, connections=10, keepalive_timeout=60,
+                 cafile=None):
+        if httpx is None:
+            raise ImportError("the http2 transport requires httpx[http2]")
+        super().__init__(cert, pw, cafile)
+        self.connections = connections
+        self.keepalive_timeout = keepalive_timeout
+
+    async def session(self, limit=100):
+        """
+        Returns the shared session, creating it on first use or when the
+        event loop changed
+
+        Parameters
+        ----------
+        limit : int
+          requests in flight, multiplexed over at most `connections`
+          connections so it doesn't size the pool
+        Returns
+        -------
+        session : obj
+          aiohttp.ClientSession-like wrapper of an httpx.AsyncClient
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed \
+                or self._loop is not loop:
+            await self._retire(loop)
+            self._session = _HTTP2Session(httpx.AsyncClient(
+                http2=True, verify=self.sslcontext,
+                limits=httpx.Limits(
+                    max_connections=self.connections,
+                    max_keepalive_connections=self.connections,
+                    keepalive_expiry=self.keepalive_timeout)))
+            self._loop = loop
+        return self._session
+
+
+"""
+How to use:
+session_module = Session("<base url>", transport='http2')
+resp, timings = data_pull.async_aiohttp_get_all(
+    session_module, urls, cert_path, get=True, max_concurrency=500)
+"""